@@ -0,0 +1,289 @@
+# Description: Benchmark the stages of the videogen pipeline
+#
+# Render the bundled test data (tests/data/images, audio and bgm) through
+# generate, keyframe, concat and audio_mix (and the fused render), report
+# wall time, output fps, CPU seconds and peak RSS of each stage and of each
+# keyframe effect. Results can be saved as a baseline and compared later.
+#
+#   python -m scripts.benchmark --output baseline.json
+#   python -m scripts.benchmark --profile draft --compare baseline.json
+#
+# Every stage runs in a fresh process, so CPU time and peak RSS only count
+# the ffmpeg processes of that stage. Caches are disabled.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import ffmpeg
+
+from vcg.videogen import ffmpegcli
+from vcg.videogen.bgm import BGM
+from vcg.videogen.keyframe import kfa
+from vcg.videogen.profile import default_profile, get_profile, profiles
+
+
+data = os.path.abspath(os.path.join(
+  os.path.dirname(__file__),
+  '../tests/data',
+))
+
+effects = ['pan_left', 'pan_right', 'zoom_in', 'zoom_out']
+
+# metrics compared with the baseline, and whether higher is better
+metrics = {
+  'wall': False,
+  'cpu': False,
+  'rss': False,
+  'fps': True,
+}
+
+
+def assets():
+  images = sorted(Path(data, 'images').glob('*.jpg'))
+  audio = sorted(Path(data, 'audio').glob('*.wav'))
+  subtitles = sorted(Path(data, 'audio').glob('*.ssa'))
+  return (
+    [{'frames': [str(images[i])], 'audio': str(audio[i])}
+     for i in range(len(audio))],
+    [str(s) for s in subtitles],
+  )
+
+
+def usage():
+  """
+  Resource usage of the terminated children of this process:
+  CPU seconds (user + system) and peak RSS in MB.
+  """
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # ru_maxrss is in bytes on macOS, in KB on Linux
+  unit = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+  return children.ru_utime + children.ru_stime, children.ru_maxrss / unit
+
+
+def stage(name, profile_name, cwd, inputs):
+  """
+  Run a stage of the pipeline in this (fresh) process, return its outputs
+  and metrics.
+  """
+  profile = get_profile(profile_name)
+  items, subtitles = assets()
+
+  start = time.perf_counter()
+  if name == 'generate':
+    outputs = ffmpegcli.generate(items, cwd, profile=profile)
+  elif name == 'keyframe':
+    outputs, _ = ffmpegcli.keyframe(
+      inputs, cwd, subtitles=subtitles, size=profile.size,
+      profile=profile, seed='benchmark',
+    )
+  elif name == 'concat':
+    outputs = [ffmpegcli.concat(
+      inputs, os.path.join(cwd, 'concat.mp4'), profile=profile,
+    )]
+  elif name == 'audio_mix':
+    video_file, wav, gain = inputs
+    outputs = [ffmpegcli.audio_mix(
+      video_file, wav, os.path.join(cwd, 'output.mp4'),
+      bgm_volume=f'{gain}dB',
+    )]
+  elif name == 'render':
+    output, _ = ffmpegcli.render(
+      items, os.path.join(cwd, 'render.mp4'), subtitles=subtitles,
+      profile=profile, seed='benchmark',
+    )
+    outputs = [output]
+  elif name in effects:
+    # the keyframe stage of a single landscape clip with the given effect
+    src = inputs[0]
+    input = ffmpeg.input(src)
+    video, _ = kfa(
+      input.video, size=ffmpegcli.size(src),
+      duration=ffmpegcli.duration(src), name=name, fps=profile.fps,
+      scale=profile.kfa_scale, engine=profile.kfa_engine,
+    )
+    output = os.path.join(cwd, f'{name}.mp4')
+    code = ffmpegcli.run(ffmpeg.output(
+      ffmpegcli.fit(video, *profile.size), input.audio, output,
+      **ffmpegcli.video_conf(profile), **ffmpegcli.aconf,
+      **ffmpegcli.oconf,
+    ))
+    if code != 0:
+      raise RuntimeError(f'Failed to render keyframe animation {name}')
+    outputs = [output]
+  else:
+    raise ValueError(f'Invalid stage: {name}')
+  wall = time.perf_counter() - start
+
+  cpu, rss = usage()
+  frames = sum([ffmpegcli.duration(f) for f in outputs]) * profile.fps
+  return outputs, {
+    'wall': round(wall, 3),
+    'fps': round(frames / wall, 1),
+    'cpu': round(cpu, 3),
+    'rss': round(rss, 1),
+    'frames': round(frames),
+  }
+
+
+def measure(name, profile, cwd, inputs=None):
+  # a fresh process for each stage, rusage of children starts from zero
+  context = multiprocessing.get_context('spawn')
+  with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+    return executor.submit(stage, name, profile, cwd, inputs or []).result()
+
+
+def record(results, name, measured):
+  """
+  Record the metrics of a stage, return its outputs.
+  """
+  outputs, metrics = measured
+  results.setdefault(name, []).append(metrics)
+  print('{name:<10} {wall:>8.3f}s {fps:>8.1f} fps {cpu:>8.3f} cpu-s '
+        '{rss:>8.1f} MB'.format(name=name, **metrics))
+  return outputs
+
+
+def median(runs) -> dict:
+  """
+  Median of each metric over the runs.
+  """
+  return {
+    key: round(statistics.median([run[key] for run in runs]), 3)
+    for key in runs[0]
+  }
+
+
+def benchmark(args) -> dict:
+  stages = {}
+  animations = {}
+  for _ in range(args.repeat):
+    with tempfile.TemporaryDirectory() as cwd:
+      # measure the stages, not the caches
+      os.environ.pop('VCG_RENDER_CACHE', None)
+      os.environ['VCG_IMAGE_CACHE'] = os.path.join(cwd, 'image-cache')
+      os.environ['VCG_BGM_ROOT'] = os.path.join(data, 'bgm')
+
+      clips = record(stages, 'generate',
+                     measure('generate', args.profile, cwd))
+      kfa_clips = record(stages, 'keyframe',
+                         measure('keyframe', args.profile, cwd, clips))
+      temp = record(stages, 'concat',
+                    measure('concat', args.profile, cwd, kfa_clips))[0]
+
+      # decoding the music is cached, and not a part of mixing
+      bgm = BGM.instance().random(duration=ffmpegcli.duration(temp))[1]
+      wav, gain = BGM.instance().prepare(bgm)
+      record(stages, 'audio_mix',
+             measure('audio_mix', args.profile, cwd, [temp, wav, gain]))
+
+      if not args.skip_render:
+        record(stages, 'render', measure('render', args.profile, cwd))
+
+      # the first clip is landscape, all effects are available
+      for name in effects:
+        record(animations, name,
+               measure(name, args.profile, cwd, clips[:1]))
+
+  return {
+    'meta': meta(args),
+    'stages': {name: median(runs) for name, runs in stages.items()},
+    'effects': {name: median(runs) for name, runs in animations.items()},
+  }
+
+
+def meta(args) -> dict:
+  version = subprocess.run(
+    ['ffmpeg', '-version'], capture_output=True, text=True,
+  ).stdout.split('\n')[0]
+  return {
+    'profile': args.profile,
+    'repeat': args.repeat,
+    'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+    'host': platform.node(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'python': platform.python_version(),
+    'ffmpeg': version,
+  }
+
+
+def compare(results, baseline, threshold) -> list[str]:
+  """
+  Compare the results with the baseline, return the regressions, i.e.
+  metrics worse than the baseline by more than `threshold`(ratio).
+  """
+  if results['meta']['profile'] != baseline['meta']['profile']:
+    print(f'WARNING: profile {results["meta"]["profile"]} is compared with '
+          f'baseline of profile {baseline["meta"]["profile"]}')
+
+  regressions = []
+  for group in ['stages', 'effects']:
+    for name, current in results[group].items():
+      if name not in baseline.get(group, {}):
+        continue
+      base = baseline[group][name]
+      changes = []
+      for metric, higher_is_better in metrics.items():
+        if not base.get(metric):
+          continue
+        ratio = current[metric] / base[metric]
+        worse = ratio < 1 - threshold if higher_is_better else \
+          ratio > 1 + threshold
+        if worse:
+          regressions.append(f'{name}.{metric}')
+        changes.append(f'{metric} {ratio - 1:+7.1%}{" !" if worse else "  "}')
+      print(f'{name:<10} ' + '  '.join(changes))
+
+  return regressions
+
+
+def main(args):
+  results = benchmark(args)
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+
+  if args.compare:
+    with open(args.compare, 'r') as fp:
+      baseline = json.load(fp)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+      print(f'Regressions: {", ".join(regressions)}')
+      return 1
+    print('No regression')
+
+  return 0
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--profile', default=default_profile,
+                      choices=list(profiles))
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='run the benchmark N times, report the median')
+  parser.add_argument('--skip-render', action='store_true',
+                      help='skip the fused render')
+  parser.add_argument('--output', type=str, help='save results as json')
+  parser.add_argument('--compare', type=str,
+                      help='compare with a baseline json, exit 1 on '
+                           'regressions')
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help='tolerated ratio of regressions, default to 10%%')
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+  sys.exit(main(parse_args()))
@@ -0,0 +1,135 @@
+# Description: Benchmark keyframe animation engines
+#
+# Render every keyframe animation with each engine, report the rendering
+# speed and the visual error against the reference (zoompan, 5x upscaled).
+#
+#   python -m scripts.benchmark_kfa
+#   python -m scripts.benchmark_kfa --image tests/data/images/0.jpg --seconds 5
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import time
+
+import ffmpeg
+
+from vcg.videogen.ffmpegcli import clip, run, frame_size
+from vcg.videogen.keyframe import kfa
+
+
+data = os.path.abspath(os.path.join(
+  os.path.dirname(__file__),
+  '../tests/data',
+))
+
+
+def source(image, seconds, fps):
+  """
+  Video stream of a still image, which is what keyframe() animates.
+  """
+  audio = os.path.join(data, 'audio', '0.wav')
+  video, _ = clip({'frames': [image], 'audio': audio}, extend=0, fps=fps)
+  return video.filter('trim', duration=seconds)
+
+
+def animate(video, size, seconds, fps, name, engine, scale):
+  video, _ = kfa(
+    video,
+    size=size,
+    duration=seconds,
+    name=name,
+    fps=fps,
+    scale=scale,
+    engine=engine,
+  )
+  return video
+
+
+def speed(video, frames):
+  """
+  Rendering speed in frames per second, without encoding.
+  """
+  start = time.perf_counter()
+  if run(ffmpeg.output(video, '-', f='null')) != 0:
+    raise RuntimeError('Failed to render keyframe animation')
+  elapsed = time.perf_counter() - start
+  return frames / elapsed, elapsed
+
+
+def error(video, reference, metric):
+  """
+  Visual error against the reference, ssim or psnr.
+  """
+  args = ffmpeg.filter(
+    [video, reference], metric,
+  ).output(
+    '-', f='null',
+  ).global_args(
+    '-hide_banner',
+  ).overwrite_output().compile()
+
+  process = subprocess.run(args, capture_output=True)
+  stderr = process.stderr.decode('utf-8')
+  pattern = r'All:([\d.]+)' if metric == 'ssim' else r'average:([\d.inf]+)'
+  matched = re.findall(pattern, stderr)
+  if process.returncode != 0 or not matched:
+    raise RuntimeError(f'Failed to measure {metric}')
+  return float(matched[-1])
+
+
+def main(args):
+  image = os.path.abspath(args.image)
+  w, h = frame_size(image)
+  size = (w // 2 * 2, h // 2 * 2)
+  frames = round(args.seconds * args.fps)
+  engines = [('zoompan', s) for s in args.scales] + [('crop', 1)]
+
+  results = []
+  for name in ['pan_left', 'pan_right', 'zoom_in', 'zoom_out']:
+    for engine, scale in engines:
+      def render(video, engine=engine, scale=scale):
+        return animate(video, size, args.seconds, args.fps,
+                       name, engine, scale)
+
+      fps, elapsed = speed(render(source(image, args.seconds, args.fps)),
+                           frames)
+      result = {
+        'effect': name,
+        'engine': engine,
+        'scale': scale,
+        'seconds': round(elapsed, 3),
+        'fps': round(fps, 1),
+      }
+      for metric in ['ssim', 'psnr']:
+        # the same source for both the candidate and the reference
+        src = source(image, args.seconds, args.fps).split()
+        result[metric] = error(
+          render(src[0]),
+          render(src[1], engine='zoompan', scale=5),
+          metric,
+        )
+      results.append(result)
+      print('{effect:<10} {engine:<8} x{scale:<3} {fps:>8} fps '
+            '{seconds:>8}s  ssim {ssim:.4f}  psnr {psnr:.2f}'.format(**result))
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+
+  return results
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--image', default=os.path.join(data, 'images/0.jpg'))
+  parser.add_argument('--seconds', type=float, default=4.0)
+  parser.add_argument('--fps', type=int, default=25)
+  parser.add_argument('--scales', type=int, nargs='+', default=[5, 3, 2])
+  parser.add_argument('--output', type=str, help='save results as json')
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+  main(parse_args())
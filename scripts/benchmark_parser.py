@@ -0,0 +1,78 @@
+# Description: Benchmark the article extraction backends
+#
+# Extract sentences, image urls and metadata of saved article pages with
+# each backend of the url parser, report wall and CPU milliseconds per
+# article, and check that all backends extract the same contents.
+#
+#   python -m scripts.benchmark_parser
+#   python -m scripts.benchmark_parser --repeat 200 saved/*.html
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+
+from vcg.urlparser.parser import extractors
+
+
+data = os.path.abspath(os.path.join(
+  os.path.dirname(__file__),
+  '../tests/data',
+))
+
+
+def run(extract, pages, repeat):
+  """
+  Extract all pages `repeat` times, return the contents of the pages, and
+  the wall and CPU milliseconds per page.
+  """
+  # the soup backend prints what it extracts
+  with contextlib.redirect_stdout(io.StringIO()):
+    contents = [extract(html) for html in pages]
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(repeat):
+      for html in pages:
+        extract(html)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+  count = repeat * len(pages)
+  return contents, wall * 1000 / count, cpu * 1000 / count
+
+
+def main(args):
+  files = args.files or sorted(glob.glob(os.path.join(data, 'html', '*.html')))
+  pages = []
+  for file in files:
+    with open(file, 'r', encoding='utf-8') as fp:
+      pages.append(fp.read())
+  size = sum([len(html) for html in pages]) / len(pages) / 1024
+  print(f'{len(pages)} pages, {size:.1f} KB per page, {args.repeat} runs')
+
+  results = {}
+  for name, extract in extractors.items():
+    contents, wall, cpu = run(extract, pages, args.repeat)
+    results[name] = contents
+    print(f'{name:<6} {wall:>8.3f} ms/page {cpu:>8.3f} cpu-ms/page')
+
+  reference = results['soup']
+  for name, contents in results.items():
+    for file, content, expected in zip(files, contents, reference):
+      if content != expected:
+        print(f'ERROR: {name} extracted different contents of {file}')
+        return 1
+  return 0
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('files', nargs='*',
+                      help='saved article pages, default to tests/data/html')
+  parser.add_argument('--repeat', type=int, default=100,
+                      help='extract every page N times')
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+  sys.exit(main(parse_args()))
@@ -7,10 +7,18 @@ import pytest
 
 # BGM instance
 @pytest.fixture(scope='session', autouse=True)
-def BGM_env():
+def BGM_env(tmp_path_factory):
   workspace = os.path.dirname(__file__)
   path = os.path.join(workspace, 'data', 'bgm')
   os.environ['VCG_BGM_ROOT'] = path
+  # decoded copies and the index, not shared with other runs
+  os.environ['VCG_BGM_CACHE'] = str(tmp_path_factory.mktemp('bgm-cache'))
+
+
+# normalized images, not shared with other runs
+@pytest.fixture(scope='session', autouse=True)
+def image_env(tmp_path_factory):
+  os.environ['VCG_IMAGE_CACHE'] = str(tmp_path_factory.mktemp('image-cache'))
 
 
 # BGM instance
@@ -3,9 +3,12 @@
 import pytest
 from unittest.mock import patch
 
+import ffmpeg
 import os
+import shutil
 
 from vcg.videogen.bgm import BGM
+from vcg.videogen.cache import locked
 
 
 def test_BGM_instance():
@@ -53,3 +56,135 @@ def test_BGM_singleton(workspace):
     assert bgm is not None
     assert root == str(bgm._root)
     assert bgm == BGM.instance()
+
+
+def test_BGM_prepare(tmp_path):
+  bgm = BGM(cache=os.path.join(tmp_path, 'cache'))
+  file = bgm[bgm.all()[0]]
+
+  wav, gain = bgm.prepare(file)
+  probe = ffmpeg.probe(wav)['streams'][0]
+  assert probe['codec_name'] == 'pcm_f32le'
+  assert (probe['sample_rate'], probe['channels']) == ('44100', 2)
+  assert gain < 0
+
+  # cached
+  with patch('vcg.videogen.bgm.ffmpeg.run') as mock_run:
+    assert bgm.prepare(file) == (wav, gain)
+    mock_run.assert_not_called()
+
+  assert len(bgm.prepare_all()) == len(bgm)
+
+
+def test_BGM_prepare_evict(tmp_path):
+  # room for one decoded copy only
+  with patch('vcg.videogen.bgm.bgm_cache_size', 40):
+    bgm = BGM(cache=os.path.join(tmp_path, 'cache'))
+  first, _ = bgm.prepare(bgm['bgm001.m4a'])
+  second, _ = bgm.prepare(bgm['bgm003.m4a'])
+  assert not os.path.exists(first)
+  assert os.path.exists(second)
+
+
+def test_BGM_prepare_lock(tmp_path):
+  bgm = BGM(cache=os.path.join(tmp_path, 'cache'))
+  file = bgm[bgm.all()[0]]
+  waits = []
+
+  # another worker is decoding the same file
+  with patch('vcg.videogen.bgm.locked', wraps=locked) as mock_locked:
+    bgm.prepare(file, progress=waits.append)
+  path, on_wait = mock_locked.call_args.args
+  on_wait(5.0)
+  assert waits == [{'queued': 5.0}]
+
+  # the instance lock is not held while decoding
+  def decode(*args):
+    assert not bgm._lock.locked()
+    raise RuntimeError('decode')
+  with patch.object(BGM, '_decode', side_effect=decode):
+    with pytest.raises(RuntimeError) as e:
+      bgm.prepare(bgm[bgm.all()[1]])
+  assert 'decode' in str(e.value)
+
+
+def test_BGM_prepare_mtime(tmp_path):
+  file = shutil.copy(BGM()[BGM().all()[0]], tmp_path)
+  bgm = BGM(path=tmp_path, cache=os.path.join(tmp_path, 'cache'))
+  bgm.prepare(file)
+
+  stat = os.stat(file)
+  os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+  with patch('vcg.videogen.bgm.ffmpeg.run', wraps=ffmpeg.run) as mock_run:
+    bgm.prepare(file)
+    mock_run.assert_called_once()
+
+
+def test_BGM_index(tmp_path):
+  root = os.path.join(tmp_path, 'bgm')
+  os.makedirs(os.path.join(root, 'sub'))
+  files = BGM().all()
+  shutil.copy(BGM()[files[0]], root)
+  shutil.copy(BGM()[files[1]], os.path.join(root, 'sub'))
+  cache = os.path.join(tmp_path, 'cache')
+
+  bgm = BGM(path=root, cache=cache)
+  assert sorted(bgm.all()) == sorted(files[:2])
+  meta = bgm.meta(files[0])
+  assert meta['duration'] > 0
+  assert meta['codec'] == 'aac'
+  assert meta['sample_rate'] in (44100, 48000)
+  assert meta['loudness'] is None
+
+  # loudness is recorded once measured, without rewriting the index
+  # shared by the workers
+  index = bgm._index_file.read_bytes()
+  bgm.prepare(bgm[files[0]])
+  assert bgm.meta(files[0])['loudness'] < 0
+  assert bgm._index_file.read_bytes() == index
+
+  # loaded from the persistent index without probing
+  with patch('vcg.videogen.bgm.ffmpeg.probe') as mock_probe:
+    bgm = BGM(path=root, cache=cache, ttl=0)
+    mock_probe.assert_not_called()
+  assert bgm.meta(files[0])['loudness'] < 0
+
+  # trusted until the ttl expires
+  shutil.copy(BGM()[files[2]], os.path.join(root, 'sub'))
+  with patch.object(BGM, '_refresh') as mock_refresh:
+    assert len(BGM(path=root, cache=cache)) == 2
+    mock_refresh.assert_not_called()
+
+  # only new files are probed
+  with patch('vcg.videogen.bgm.ffmpeg.probe',
+             wraps=ffmpeg.probe) as mock_probe:
+    progress = []
+    bgm = BGM(path=root, cache=cache, ttl=0, progress=progress.append)
+    mock_probe.assert_called_once()
+  assert len(bgm) == 3
+  assert progress == [{'probed': 1, 'total': 1}]
+
+  # files replaced in place are probed again
+  durations = {k: bgm.meta(k)['duration'] for k in files[:3]}
+  shutil.copy(bgm[files[2]], bgm[files[0]])
+  stat = os.stat(bgm[files[0]])
+  os.utime(bgm[files[0]],
+           ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+  bgm = BGM(path=root, cache=cache, ttl=0)
+  assert bgm.meta(files[0])['duration'] == durations[files[2]]
+  assert bgm.meta(files[1])['duration'] == durations[files[1]]
+
+
+def test_BGM_random_duration():
+  bgm = BGM()
+  for _ in range(10):
+    key, _ = bgm.random(duration=60)
+    assert 60 <= bgm.meta(key)['duration'] <= 180
+
+  # no music fits, pick a longer one
+  durations = sorted([bgm.meta(k)['duration'] for k in bgm.all()])
+  key, _ = bgm.random(duration=durations[-1] - 1)
+  assert bgm.meta(key)['duration'] == durations[-1]
+
+  # no music is long enough
+  assert bgm.random(duration=3600) != ('', '')
@@ -0,0 +1,92 @@
+# Path: tests/test_cache.py
+
+from unittest.mock import patch
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from vcg.videogen.cache import FileCache, file_digest, locked
+
+
+def write(path, size):
+  with open(path, 'wb') as fp:
+    fp.write(os.urandom(size))
+  return path
+
+
+def test_file_cache(tmp_path):
+  cache = FileCache(os.path.join(tmp_path, 'cache'), max_bytes=1000)
+  src = write(os.path.join(tmp_path, 'src.mp4'), 400)
+  key = file_digest(src)
+
+  dest = os.path.join(tmp_path, 'dest.mp4')
+  assert not cache.get(key, dest)
+  cache.put(key, src)
+  assert cache.get(key, dest)
+  assert os.stat(dest).st_ino == os.stat(src).st_ino
+  assert file_digest(dest) == key
+  assert cache.size() == 400
+
+  # dest is replaced
+  assert cache.get(key, dest)
+
+
+def test_file_cache_evict(tmp_path):
+  cache = FileCache(os.path.join(tmp_path, 'cache'), max_bytes=1000)
+  keys = []
+  for i in range(3):
+    src = write(os.path.join(tmp_path, f'{i}.mp4'), 400)
+    keys.append(file_digest(src))
+    cache.put(keys[-1], src)
+    # mtime resolution
+    time.sleep(0.01)
+    if i == 1:
+      # the first one is used recently
+      assert cache.get(keys[0], os.path.join(tmp_path, 'used.mp4'))
+      time.sleep(0.01)
+
+  assert cache.size() == 800
+  dest = os.path.join(tmp_path, 'dest.mp4')
+  assert cache.get(keys[0], dest)
+  assert not cache.get(keys[1], dest)
+  assert cache.get(keys[2], dest)
+
+
+def test_file_cache_data(tmp_path):
+  cache = FileCache(os.path.join(tmp_path, 'cache'), max_bytes=1000)
+  assert cache.read('key', '.json') is None
+  cache.write('key', b'{"size": 400}', '.json')
+  assert cache.read('key', '.json') == b'{"size": 400}'
+  # not the same entry
+  assert cache.read('key') is None
+  assert cache.size() == 13
+
+
+def test_locked(tmp_path):
+  path = os.path.join(tmp_path, 'locks', 'key.lock')
+  waits = []
+  with locked(path):
+    # held by another worker
+    def worker():
+      with locked(path, on_wait=waits.append, interval=0.05, poll=0.01):
+        pass
+    thread = threading.Thread(target=worker)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+  thread.join(timeout=1)
+  assert not thread.is_alive()
+  assert len(waits) > 0
+
+
+def test_file_digest_memo(tmp_path):
+  files = [write(os.path.join(tmp_path, f'{i}.bin'), 16) for i in range(3)]
+  with patch('vcg.videogen.cache.max_digests', 2), \
+       patch('vcg.videogen.cache._digests', OrderedDict()) as digests:
+    digests_of = [file_digest(f) for f in files]
+    assert len(digests) == 2
+    # memoized digests are the same as computed ones
+    assert [file_digest(f) for f in files] == digests_of
+    assert len(digests) == 2
@@ -0,0 +1,70 @@
+# Path: tests/test_image.py
+
+import pytest
+from unittest.mock import patch
+
+import os
+from PIL import Image
+
+from vcg.videogen.image import normalize, normalize_all, target_size
+from vcg.videogen.image import orientation_tag
+
+
+@pytest.fixture(autouse=True)
+def image_cache(tmp_path):
+  with patch.dict('os.environ', {
+    'VCG_IMAGE_CACHE': os.path.join(tmp_path, 'cache'),
+  }):
+    yield
+
+
+def test_target_size():
+  # downscaled to the canvas width with headroom
+  assert target_size((3000, 2000), (720, 1280)) == (1080, 720)
+  assert target_size((3000, 2000), (720, 1280), headroom=1.0) == (720, 480)
+  # never upscaled
+  assert target_size((1080, 608), (720, 1280)) == (1080, 608)
+  assert target_size((400, 300), (720, 1280)) == (400, 300)
+
+
+def test_normalize(workspace, tmp_path):
+  # already fits the canvas
+  original = os.path.join(workspace, 'images', '0.jpg')
+  assert normalize(original, (720, 1280), tmp_path) == original
+
+  # a large photo, rotated by 90 degrees clockwise in EXIF
+  photo = os.path.join(tmp_path, 'photo.jpg')
+  exif = Image.Exif()
+  exif[orientation_tag] = 6
+  Image.new('RGB', (4000, 3000), 'red').save(photo, exif=exif)
+
+  cwd = os.path.join(tmp_path, 'cwd')
+  os.makedirs(cwd)
+  normalized = normalize(photo, (720, 1280), cwd)
+  assert os.path.dirname(normalized) == cwd
+  with Image.open(normalized) as image:
+    assert image.size == (1080, 1440)
+    assert image.getexif().get(orientation_tag, 1) == 1
+
+  # taken from the cache
+  os.remove(normalized)
+  assert normalize(photo, (720, 1280), cwd) == normalized
+  assert os.path.exists(normalized)
+
+  # transparency is kept
+  logo = os.path.join(tmp_path, 'logo.png')
+  Image.new('RGBA', (2000, 1000), (0, 0, 0, 0)).save(logo)
+  normalized = normalize(logo, (360, 640), cwd)
+  assert normalized.endswith('.png')
+  with Image.open(normalized) as image:
+    assert image.size == (540, 270)
+    assert image.mode == 'RGBA'
+
+
+def test_normalize_animated(tmp_path):
+  gif = os.path.join(tmp_path, 'animated.gif')
+  frames = [Image.new('RGB', (2000, 1000), color)
+            for color in ['red', 'green', 'blue']]
+  frames[0].save(gif, save_all=True, append_images=frames[1:], duration=100)
+  # animated images are looped by ffmpeg as they are
+  assert normalize_all([gif], (720, 1280), tmp_path) == [gif]
@@ -88,6 +88,7 @@ async def test_localflow(
     params['output'],
     params['bgm'],
     params['kfa'],
+    {'encode': {}},
   )
   mock_generate_video.return_value = params['videos']
   mock_synthesize_speech.return_value = (
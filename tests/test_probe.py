@@ -0,0 +1,84 @@
+# Path: tests/test_probe.py
+
+import pytest
+from unittest.mock import patch
+
+import ffmpeg
+import os
+import shutil
+from pathlib import Path
+
+from vcg.videogen.probe import Probe, wav_duration
+
+
+@pytest.fixture
+def wavs(workspace):
+  path = Path(os.path.join(workspace, 'audio'))
+  return sorted([str(f) for f in path.glob('**/*.wav')])
+
+
+def test_wav_duration(wavs):
+  for wav in wavs:
+    probe = ffmpeg.probe(wav)
+    expected = float(probe['format']['duration'])
+    assert wav_duration(wav) == pytest.approx(expected, abs=1e-3)
+
+
+def test_wav_duration_invalid(workspace):
+  image = os.path.join(workspace, 'images', '0.jpg')
+  assert wav_duration(image) is None
+
+
+def test_probe_wav_without_ffprobe(wavs):
+  probe = Probe()
+  with patch('vcg.videogen.probe.ffmpeg.probe') as mock_probe:
+    assert probe.duration(wavs[0]) > 0
+    mock_probe.assert_not_called()
+
+
+def test_probe_cache(workspace, tmp_path):
+  image = shutil.copy(os.path.join(workspace, 'images', '0.jpg'), tmp_path)
+  probe = Probe()
+
+  width, height = probe.size(image)
+  assert (probe.hits, probe.misses) == (0, 1)
+  assert probe.size(image) == (width, height)
+  assert (probe.hits, probe.misses) == (1, 1)
+
+  # cache is invalidated by mtime
+  stat = os.stat(image)
+  os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+  assert probe.size(image) == (width, height)
+  assert (probe.hits, probe.misses) == (1, 2)
+
+  probe.clear()
+  assert (probe.hits, probe.misses) == (0, 0)
+
+
+def test_probe_cache_size(wavs):
+  probe = Probe(max_entries=2)
+  for wav in wavs[:3]:
+    probe.duration(wav)
+  assert len(probe) == 2
+
+  # least recently used results are dropped
+  probe.duration(wavs[1])
+  probe.duration(wavs[0])
+  assert (probe.hits, probe.misses) == (1, 4)
+  assert len(probe) == 2
+
+  with patch.dict('os.environ', {'VCG_PROBE_CACHE_SIZE': '1'}):
+    probe = Probe()
+  for wav in wavs[:3]:
+    probe.duration(wav)
+  assert len(probe) == 1
+
+
+def test_probe_no_video(wavs):
+  with pytest.raises(RuntimeError) as e:
+    Probe().size(wavs[0])
+  assert 'No video stream' in str(e.value)
+
+
+def test_probe_singleton():
+  assert Probe.instance() is Probe.instance()
@@ -0,0 +1,53 @@
+# Path: tests/test_scheduler.py
+
+import pytest
+
+import ffmpeg
+
+from vcg.videogen.scheduler import Scheduler
+from vcg.videogen.ffmpegcli import command
+
+
+def test_slot(tmp_path):
+  scheduler = Scheduler(slots=2, root=str(tmp_path), cores=8)
+  assert scheduler.busy() == 0
+
+  # the budget is per slot, the first job does not take all the cores
+  with scheduler.slot() as threads:
+    assert threads == 4
+    assert scheduler.busy() == 1
+    # another process(scheduler) shares the same lock files
+    other = Scheduler(slots=2, root=str(tmp_path), cores=8)
+    with other.slot() as threads:
+      assert threads == 4
+      assert other.busy() == 2
+      with pytest.raises(TimeoutError):
+        with scheduler.slot(timeout=0.2):
+          pass
+
+  assert scheduler.busy() == 0
+  # never more threads than cores in total
+  assert Scheduler(slots=16, root=str(tmp_path), cores=32).threads() == 2
+  assert Scheduler(slots=4, root=str(tmp_path), cores=2).threads() == 1
+
+
+def test_slot_on_wait(tmp_path):
+  scheduler = Scheduler(slots=1, root=str(tmp_path), cores=2, poll=0.01)
+  waits = []
+  with scheduler.slot():
+    with pytest.raises(TimeoutError):
+      with scheduler.slot(timeout=0.2, on_wait=waits.append, interval=0.05):
+        pass
+  assert len(waits) > 0
+  assert all(w >= 0.05 for w in waits)
+
+
+def test_command_threads():
+  stream = ffmpeg.input('input.mp4').output('output.mp4')
+  args = command(stream, threads=2)
+  assert args[:5] == ['ffmpeg',
+                      '-filter_threads', '2',
+                      '-filter_complex_threads', '2']
+  assert args[-4:] == ['-threads', '2', 'output.mp4', '-y']
+
+  assert command(stream) == stream.overwrite_output().compile()
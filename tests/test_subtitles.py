@@ -0,0 +1,53 @@
+# Path: tests/test_subtitles.py
+
+import pytest
+
+import os
+import pysubs2
+from pathlib import Path
+
+from vcg.videogen.subtitles import merge, rescale, play_res
+
+
+@pytest.fixture
+def subtitles(workspace):
+  path = Path(os.path.join(workspace, 'audio'))
+  return sorted([str(f) for f in path.glob('**/*.ssa')])
+
+
+def test_rescale(subtitles):
+  subs = pysubs2.load(subtitles[0])
+  assert play_res(subs) == (720, 1280)
+  style = subs.styles['top'].copy()
+
+  rescale(subs, (360, 640))
+  assert play_res(subs) == (360, 640)
+  assert subs.styles['top'].fontsize == pytest.approx(style.fontsize / 2)
+  assert subs.styles['top'].marginv == round(style.marginv / 2)
+
+  # landscape, font size fits the width
+  subs = rescale(pysubs2.load(subtitles[0]), (1280, 720))
+  assert subs.styles['top'].fontsize == pytest.approx(
+    style.fontsize * 720 / 1280, abs=0.01)
+  assert subs.styles['top'].marginl == round(style.marginl * 1280 / 720)
+
+
+def test_merge(subtitles):
+  durations = [2.5, 3.0, 1.5]
+  merged = merge(subtitles[:3], durations, (360, 640))
+  assert play_res(merged) == (360, 640)
+  assert list(merged.styles.keys()) == ['top']
+
+  offset = 0
+  for file, d in zip(subtitles[:3], durations):
+    subs = pysubs2.load(file)
+    events = merged.events[:len(subs.events)]
+    merged.events = merged.events[len(subs.events):]
+    assert [e.start for e in events] == [e.start + offset for e in subs]
+    assert [e.text for e in events] == [e.text for e in subs]
+    offset += round(d * 1000)
+  assert merged.events == []
+
+  with pytest.raises(ValueError) as e:
+    merge(subtitles[:3], durations[:2], (360, 640))
+  assert 'must be the same' in str(e)
@@ -4,9 +4,71 @@ import pytest
 from unittest.mock import patch
 
 import os
+import shutil
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
 
-from vcg.urlparser.parser import parse
+from vcg.urlparser.parser import download_images, extract, parse
+from vcg.urlparser.parser import split_frames, variant_url
 from vcg.urlparser.activity import parse_url
+from vcg.urlparser.imagefilter import ImageFilter
+from vcg.urlparser.downloader import Downloader, local_name
+
+
+class Handler(SimpleHTTPRequestHandler):
+  # paths failed once with 503, to test retries
+  failed = set()
+  requests = []
+
+  def do_GET(self):
+    self.requests.append(self.path)
+    if self.path.startswith('/flaky/') and self.path not in self.failed:
+      self.failed.add(self.path)
+      self.send_error(503)
+      return
+    self.path = self.path.removeprefix('/flaky')
+    super().do_GET()
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def download_cache(tmp_path):
+  with patch.dict('os.environ', {
+    'VCG_DOWNLOAD_CACHE': os.path.join(tmp_path, 'cache'),
+  }), patch.object(Downloader, '_singleton', None):
+    yield os.path.join(tmp_path, 'cache')
+
+
+def serve(directory):
+  handler = partial(Handler, directory=directory)
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f'http://127.0.0.1:{httpd.server_address[1]}'
+  httpd.shutdown()
+  httpd.server_close()
+
+
+@pytest.fixture
+def server(workspace):
+  yield from serve(os.path.join(workspace, 'images'))
+
+
+@pytest.fixture
+def decorations(workspace, tmp_path):
+  # a photo among decorative images of an article
+  path = os.path.join(tmp_path, 'decorations')
+  os.makedirs(path)
+  shutil.copy(os.path.join(workspace, 'images', '0.jpg'), path)
+  Image.new('RGB', (900, 300), 'red').save(os.path.join(path, 'banner.jpg'))
+  Image.new('RGB', (1080, 12)).save(os.path.join(path, 'divider.png'))
+  Image.new('RGB', (64, 64)).save(os.path.join(path, 'icon.gif'))
+  Image.new('L', (430, 430)).save(os.path.join(path, 'qrcode.png'))
+  yield from serve(path)
 
 
 def test_parse(tmp_path):
@@ -19,6 +81,196 @@ def test_parse(tmp_path):
   assert os.path.exists(os.path.join(tmp_path, 'sentences.json'))
 
 
+def test_download_all(server, workspace, tmp_path):
+  names = ['3.jpg', '0.jpg', '6.jpg', '1.jpg', '5.jpg', '2.jpg', '7.jpg']
+  urls = [f'{server}/{name}' for name in names]
+  urls += [f'{server}/flaky/0.jpg', f'{server}/not_exist.jpg']
+
+  downloader = Downloader(workers=4, backoff=0)
+  path = os.path.join(tmp_path, 'images')
+  files = downloader.download_all(urls, path)
+
+  # same order as the urls, named by sha1 of the urls
+  assert files[:-1] == [os.path.join(path, local_name(url))
+                        for url in urls[:-1]]
+  for file, name in zip(files, names + ['0.jpg']):
+    with open(file, 'rb') as fp:
+      with open(os.path.join(workspace, 'images', name), 'rb') as origin:
+        assert fp.read() == origin.read()
+  # failed after retries
+  assert files[-1] is None
+  assert sorted(os.listdir(path)) == sorted(
+    [os.path.basename(f) for f in files[:-1]])
+
+
+def test_download_cache(server, tmp_path):
+  urls = [f'{server}/0.jpg', f'{server}/3.jpg', f'{server}/flaky/0.jpg']
+  first = Downloader(workers=1, backoff=0).download_all(
+    urls, os.path.join(tmp_path, 'first'))
+
+  # another job downloads the same images
+  Handler.requests.clear()
+  second = Downloader(backoff=0).download_all(
+    urls, os.path.join(tmp_path, 'second'))
+  assert Handler.requests == []
+  for a, b in zip(first, second):
+    assert os.path.basename(a) == os.path.basename(b)
+    # hardlinks of the cached content
+    assert os.stat(a).st_ino == os.stat(b).st_ino
+  # same content behind different urls is stored once
+  assert os.stat(second[0]).st_ino == os.stat(second[2]).st_ino
+
+
+def test_variant_url():
+  url = 'https://mmbiz.qpic.cn/mmbiz_jpg/Ab3x/640?wx_fmt=jpeg&from=appmsg'
+  assert variant_url(url, 1280) == \
+    'https://mmbiz.qpic.cn/mmbiz_jpg/Ab3x/1280?wx_fmt=jpeg&from=appmsg'
+  assert variant_url('http://mmbiz.qpic.cn/mmbiz/Cd4y/0/', 1280) == \
+    'http://mmbiz.qpic.cn/mmbiz/Cd4y/1280'
+  # animations are kept
+  assert variant_url(
+    'https://mmbiz.qpic.cn/mmbiz_gif/Ef5z/640?wx_fmt=gif', 1280) is None
+  assert variant_url(
+    'https://mmbiz.qpic.cn/mmbiz_png/Ef5z/640?wx_fmt=gif', 1280) is None
+  # not on the CDN
+  assert variant_url('https://example.com/mmbiz_jpg/Ab3x/640', 1280) is None
+  assert variant_url('https://mmbiz.qpic.cn/logo.png', 1280) is None
+
+
+def test_download_variant(server, workspace, tmp_path):
+  urls = [f'{server}/0.jpg', f'{server}/1.jpg']
+  # a variant of 0.jpg, and a missing one of 1.jpg
+  variants = {urls[0]: f'{server}/6.jpg', urls[1]: f'{server}/none.jpg'}
+
+  path = os.path.join(tmp_path, 'images')
+  files = Downloader(backoff=0).download_all(
+    urls, path, variant=variants.get)
+  # named by the urls
+  assert files == [os.path.join(path, local_name(url)) for url in urls]
+  for file, name in zip(files, ['6.jpg', '1.jpg']):
+    with open(file, 'rb') as fp:
+      with open(os.path.join(workspace, 'images', name), 'rb') as origin:
+        assert fp.read() == origin.read()
+
+  # cached by the variants, including the fallback
+  Handler.requests.clear()
+  Downloader().download_all(
+    urls, os.path.join(tmp_path, 'second'), variant=variants.get)
+  assert Handler.requests == []
+
+
+def test_image_filter():
+  image_filter = ImageFilter()
+  assert image_filter.reason((1080, 608)) is None
+  assert image_filter.reason((1080, 1080)) is None
+  assert image_filter.reason((1080, 20)) == 'divider'
+  assert image_filter.reason((8, 1080)) == 'divider'
+  # long infographics and screenshots are kept
+  assert image_filter.reason((1080, 7000)) is None
+  assert image_filter.reason((200, 1400)) is None
+  assert image_filter.reason((48, 48)) == 'icon'
+  assert image_filter.reason((1080, 400)) == 'banner'
+  assert image_filter.reason((258, 258)) == 'qrcode'
+  assert image_filter.reason((0, 0)) == 'empty'
+
+  with patch.dict('os.environ', {
+    'VCG_IMAGE_FILTER_MAX_RATIO': '3',
+    'VCG_IMAGE_FILTER_QRCODE_SIZE': '0',
+  }):
+    image_filter = ImageFilter.from_env()
+  assert image_filter.reason((1080, 400)) is None
+  assert image_filter.reason((258, 258)) is None
+  assert image_filter.min_size == ImageFilter.min_size
+
+
+def test_download_images(decorations, tmp_path):
+  names = ['banner.jpg', '0.jpg', 'divider.png', 'icon.gif', 'qrcode.png']
+  urls = [f'{decorations}/{name}' for name in names]
+
+  path = os.path.join(tmp_path, 'first')
+  images, skipped = download_images(urls, path, ImageFilter())
+  assert images == [os.path.join(path, local_name(urls[1]))]
+  assert os.listdir(path) == [local_name(urls[1])]
+  assert skipped == [
+    {'url': urls[0], 'reason': 'banner', 'format': 'JPEG',
+     'size': [900, 300]},
+    {'url': urls[2], 'reason': 'divider', 'format': 'PNG',
+     'size': [1080, 12]},
+    {'url': urls[3], 'reason': 'icon', 'format': 'GIF', 'size': [64, 64]},
+    {'url': urls[4], 'reason': 'qrcode', 'format': 'PNG',
+     'size': [430, 430]},
+  ]
+
+  # headers of the skipped images are cached, nothing is requested again
+  Handler.requests.clear()
+  path = os.path.join(tmp_path, 'second')
+  assert download_images(urls, path, ImageFilter()) == (
+    [os.path.join(path, local_name(urls[1]))], skipped)
+  assert Handler.requests == []
+
+  # all downloaded without a filter
+  images, skipped = download_images(urls, os.path.join(tmp_path, 'third'))
+  assert len(images) == len(urls)
+  assert skipped == []
+
+
+def test_extract(workspace):
+  with open(os.path.join(workspace, 'html', 'article.html')) as fp:
+    html = fp.read()
+
+  sentences, urls, metadata = extract(html, backend='lxml')
+  assert (sentences, urls, metadata) == extract(html, backend='soup')
+
+  # scripts, styles, templates and comments are not a part of the text
+  assert sentences == [
+    '夜晚的城市安静下来，正是跑步的好时候。',
+    '跑前十分钟做好热身，活动脚踝和膝盖。',
+    '选择灯光充足、车辆较少的路线\xa0，穿上带反光条的衣服。',
+    '跑后及时补水，拉伸放松五到十分钟。',
+    '。',
+  ]
+  assert urls == [
+    'https://mmbiz.qpic.cn/mmbiz_jpg/a1/640?wx_fmt=jpeg',
+    'https://mmbiz.qpic.cn/mmbiz_png/b2/640?wx_fmt=png',
+    'https://mmbiz.qpic.cn/mmbiz_gif/c3/640?wx_fmt=gif',
+    'https://mmbiz.qpic.cn/mmbiz_png/qrcode/0?wx_fmt=png',
+  ]
+  assert metadata == {
+    'title': '城市夜跑指南',
+    'url': 'http://mp.weixin.qq.com/s?__biz=MzA3&mid=2650&idx=1&sn=8f3d',
+    'desc': '夜跑前后需要注意的几件事',
+    'image': 'https://mmbiz.qpic.cn/mmbiz_jpg/cover/0?wx_fmt=jpeg',
+  }
+
+  with pytest.raises(ValueError):
+    extract(html, backend='regex')
+
+
+def test_split_frames(workspace, tmp_path):
+  jpeg = os.path.join(workspace, 'images', '0.jpg')
+  # downloaded images are all named .jpg
+  png = os.path.join(tmp_path, 'png.jpg')
+  Image.new('RGBA', (64, 48), (255, 0, 0, 128)).save(png, format='PNG')
+  gif = os.path.join(tmp_path, 'gif.jpg')
+  frames = [Image.new('RGB', (64, 48), (i * 20, 0, 0)) for i in range(12)]
+  frames[0].save(gif, format='GIF', save_all=True,
+                 append_images=frames[1:], duration=100)
+
+  outdir = os.path.join(tmp_path, 'images')
+  files = split_frames([jpeg, png, gif], outdir)
+
+  assert files == [os.path.join(outdir, name) for name in
+                   ['0-1.jpg', '1-1.jpg'] +
+                   [f'2-{n}.jpg' for n in range(1, 11)]]
+  # static jpeg is linked(or copied across devices) as it is
+  with open(files[0], 'rb') as fp, open(jpeg, 'rb') as original:
+    assert fp.read() == original.read()
+  for file in files[1:]:
+    with Image.open(file) as image:
+      assert image.format == 'JPEG'
+      assert image.size == (64, 48)
+
+
 @pytest.mark.asyncio
 @patch('vcg.urlparser.activity.parse')
 async def test_parse_url(mock_parse, params):
@@ -3,13 +3,26 @@
 import pytest
 from unittest.mock import patch
 
+import asyncio
 import ffmpeg
 import os
+import pysubs2
+import subprocess
+from dataclasses import replace
 from pathlib import Path
+from temporalio.testing import ActivityEnvironment
 
 from vcg.videogen.ffmpegcli import generate, keyframe, concat, audio_mix
-from vcg.videogen.activity import generate_video, concat_video
+from vcg.videogen.ffmpegcli import render, duration, size, concat_copy
+from vcg.videogen.ffmpegcli import clip, run, parse_progress
+from vcg.videogen.ffmpegcli import arun, agenerate, output_file, ladder
+from vcg.videogen.ffmpegcli import pconf, preview_files, command
+from vcg.videogen.ffmpegcli import rendition_files
+from vcg.videogen.activity import generate_video, concat_video, render_video
 from vcg.videogen.bgm import BGM
+from vcg.videogen.profile import get_profile, get_rendition
+from vcg.videogen.keyframe import kfa
+from vcg.videogen.subtitles import play_res
 
 
 def validation(filename):
@@ -72,6 +85,98 @@ def test_generate(assets, tmp_path):
     assert valid
 
 
+def test_generate_workers(assets, tmp_path):
+  os.makedirs(tmp_path / 'serial')
+  os.makedirs(tmp_path / 'parallel')
+  serial = generate(assets=assets, cwd=tmp_path / 'serial', workers=1)
+  parallel = generate(assets=assets, cwd=tmp_path / 'parallel', workers=4)
+  assert [os.path.basename(v) for v in serial] == \
+    [os.path.basename(v) for v in parallel]
+  for i, video in enumerate(parallel):
+    assert video == os.path.join(tmp_path / 'parallel', f'{i}.mp4')
+    assert duration(video) == pytest.approx(duration(serial[i]), abs=0.1)
+
+
+def test_run_progress(assets, tmp_path):
+  video, audio = clip(assets[0])
+  stream = ffmpeg.concat(video, audio, v=1, a=1).output(
+    os.path.join(tmp_path, 'progress.mp4'),
+  )
+
+  reports = []
+  assert run(stream, progress=reports.append) == 0
+  assert len(reports) > 0
+  assert reports[-1]['done']
+  assert reports[-1]['frame'] > 0
+  assert reports[-1]['out_time'] == pytest.approx(
+    duration(assets[0]['audio']) + 0.5, abs=0.2)
+
+  # ffmpeg is killed if the callback fails
+  def fail(info):
+    raise ValueError('callback failed')
+
+  processes = []
+  popen = subprocess.Popen
+  with patch('vcg.videogen.ffmpegcli.subprocess.Popen',
+             side_effect=lambda *a, **kw: processes.append(
+               popen(*a, **kw)) or processes[-1]):
+    with pytest.raises(ValueError):
+      run(stream, progress=fail)
+  assert processes[0].returncode is not None
+
+  info = parse_progress({'frame': '10', 'fps': '0.00', 'speed': 'N/A',
+                         'bitrate': '1.5kbits/s', 'progress': 'continue'})
+  assert info['frame'] == 10
+  assert info['speed'] is None
+  assert info['bitrate'] == 1.5
+  assert info['out_time'] is None
+  assert not info['done']
+
+
+@pytest.mark.asyncio
+async def test_arun(assets, tmp_path):
+  video, audio = clip(assets[0])
+  stream = ffmpeg.concat(video, audio, v=1, a=1).output(
+    os.path.join(tmp_path, 'arun.mp4'),
+  )
+
+  reports = []
+  assert await arun(stream, progress=reports.append) == 0
+  assert reports[-1]['done']
+  valid, _ = validation(os.path.join(tmp_path, 'arun.mp4'))
+  assert valid
+
+  videos = await agenerate(assets=assets[:2], cwd=tmp_path, workers=2)
+  assert videos == [os.path.join(tmp_path, f'{i}.mp4') for i in range(2)]
+
+
+@pytest.mark.asyncio
+async def test_arun_cancel(tmp_path):
+  # endless input, only stops when killed
+  stream = ffmpeg.input(
+    'anullsrc', f='lavfi',
+  ).output(
+    os.path.join(tmp_path, 'endless.wav'),
+  )
+
+  processes = []
+  create_subprocess_exec = asyncio.create_subprocess_exec
+
+  async def spawn(*args, **kwargs):
+    processes.append(await create_subprocess_exec(*args, **kwargs))
+    return processes[-1]
+
+  with patch('asyncio.create_subprocess_exec', side_effect=spawn):
+    task = asyncio.create_task(arun(stream))
+    while not processes:
+      await asyncio.sleep(0.1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await task
+  # ffmpeg is killed
+  assert processes[0].returncode is not None
+
+
 def test_keyframe(assets, tmp_path):
   videos = generate(assets=assets, cwd=tmp_path, verbose=True)
   outputs, names = keyframe(videos=videos, cwd=tmp_path, verbose=True)
@@ -83,6 +188,74 @@ def test_keyframe(assets, tmp_path):
     assert valid
 
 
+def test_kfa_engine():
+  def compile(**kwargs):
+    video, name = kfa(ffmpeg.input('input.mp4').video, size=(1080, 608),
+                      duration=4.0, **kwargs)
+    return ' '.join(ffmpeg.output(video, 'output.mp4').compile()), name
+
+  for name in ['pan_left', 'pan_right', 'zoom_in', 'zoom_out']:
+    args, _ = compile(name=name)
+    assert 'zoompan' in args and 'perspective' not in args
+    args, _ = compile(name=name, engine='crop')
+    assert 'perspective' in args and 'zoompan' not in args
+
+  args, _ = compile(name='zoom_in', engine={'zoom_in': 'crop'})
+  assert 'perspective' in args
+  args, _ = compile(name='zoom_out', engine={'zoom_in': 'crop'})
+  assert 'zoompan' in args
+
+  with pytest.raises(ValueError) as e:
+    compile(name='zoom_in', engine='unknown')
+  assert 'Invalid keyframe animation engine' in str(e.value)
+
+  with pytest.raises(ValueError) as e:
+    compile(name='unknown')
+  assert 'Invalid keyframe animation name' in str(e.value)
+
+  # seeded, the same effect is picked every time
+  args, name = compile(seed='seed:0')
+  assert all([compile(seed='seed:0') == (args, name) for _ in range(10)])
+
+
+def test_render_cache(assets, tmp_path):
+  cache = os.path.join(tmp_path, 'cache')
+  first = os.path.join(tmp_path, 'first')
+  second = os.path.join(tmp_path, 'second')
+  os.makedirs(first)
+  os.makedirs(second)
+
+  with patch.dict('os.environ', {'VCG_RENDER_CACHE': cache}):
+    videos = generate(assets=assets[:2], cwd=first)
+    outputs, names = keyframe(videos=videos, cwd=first, seed='id')
+
+    with patch('vcg.videogen.ffmpegcli.run') as mock_run:
+      cached = generate(assets=assets[:2], cwd=second)
+      cached_outputs, cached_names = keyframe(videos=cached, cwd=second,
+                                              seed='id')
+      mock_run.assert_not_called()
+
+  assert cached_names == names
+  for output, cached in zip(videos + outputs, cached + cached_outputs):
+    # hardlinked from the cache
+    assert os.stat(output).st_ino == os.stat(cached).st_ino
+  valid, _ = validation(cached_outputs[0])
+  assert valid
+
+
+def test_keyframe_crop(assets, tmp_path):
+  videos = generate(assets=assets[:2], cwd=tmp_path)
+  # the crop engine is not the default of any profile
+  crop = replace(get_profile('draft'), kfa_engine='crop')
+  outputs, _ = keyframe(videos=videos, cwd=tmp_path, profile=crop)
+  assert len(outputs) == len(videos)
+  for video, output in zip(videos, outputs):
+    valid, _ = validation(output)
+    assert valid
+    assert size(output) == size(video)
+    assert duration(output) == pytest.approx(duration(video), abs=0.2)
+
+
 def test_concat(assets, subtitles, tmp_path):
   videos = generate(assets=assets, cwd=tmp_path, verbose=True)
   # videos = [os.path.join(tmp_path, f'{i}.mp4')
@@ -117,6 +290,68 @@ def test_concat(assets, subtitles, tmp_path):
   assert valid
 
 
+def test_concat_copy(assets, subtitles, tmp_path):
+  videos = generate(assets=assets[:3], cwd=tmp_path)
+  outputs, _ = keyframe(
+    videos=videos,
+    cwd=tmp_path,
+    subtitles=subtitles[:3],
+    size=(360, 640),
+  )
+
+  with patch('vcg.videogen.ffmpegcli.concat_copy') as mock_copy:
+    concat(videos=videos, size=(360, 640),
+           output=os.path.join(tmp_path, 'mixed.mp4'))
+    mock_copy.assert_not_called()
+
+  with patch('vcg.videogen.ffmpegcli.concat_copy',
+             wraps=concat_copy) as mock_copy:
+    output = concat(
+      videos=outputs,
+      size=(360, 640),
+      output=os.path.join(tmp_path, 'output.mp4'),
+    )
+    mock_copy.assert_called_once()
+  valid, _ = validation(output)
+  assert valid
+  assert size(output) == (360, 640)
+  assert duration(output) == pytest.approx(
+    sum([duration(v) for v in outputs]), abs=0.5)
+
+  # subtitles burned per clip are rescaled to the output size
+  for video in outputs:
+    subs = pysubs2.load(f'{os.path.splitext(video)[0]}.ass')
+    assert play_res(subs) == (360, 640)
+
+  with pytest.raises(ValueError) as e:
+    keyframe(videos=videos, cwd=tmp_path, subtitles=subtitles[:3])
+  assert 'output size' in str(e)
+
+
+def test_concat_burn(assets, subtitles, tmp_path):
+  videos = generate(assets=assets[:3], cwd=tmp_path)
+  outputs, _ = keyframe(videos=videos, cwd=tmp_path, size=(360, 640))
+
+  output = os.path.join(tmp_path, 'output.mp4')
+  with patch('vcg.videogen.ffmpegcli.run', wraps=run) as mock_run:
+    output = concat(videos=outputs, subtitles=subtitles[:3],
+                    size=(360, 640), output=output)
+  # no stream copy, subtitles are burned once where the video is encoded
+  args = command(mock_run.call_args.args[0])
+  assert 'concat' not in args
+  assert ' '.join(args).count('subtitles=') == 1
+  subs = pysubs2.load(os.path.join(tmp_path, 'output.ass'))
+  assert play_res(subs) == (360, 640)
+  assert len(subs.events) == sum(
+    [len(pysubs2.load(str(f)).events) for f in subtitles[:3]])
+
+  valid, _ = validation(output)
+  assert valid
+  assert size(output) == (360, 640)
+  assert duration(output) == pytest.approx(
+    sum([duration(v) for v in outputs]), abs=0.5)
+
+
 def bgms(workspace):
   bgm_path = Path(os.path.join(workspace, 'bgm'))
   return sorted([*bgm_path.glob('**/*.m4a')])
@@ -133,13 +368,191 @@ def test_audio_mix(assets, tmp_path):
   assert 'Failed to add background music' in str(e)
 
   mixed = os.path.join(tmp_path, 'with_bgm.mp4')
-  mixed = audio_mix(output, BGM.instance().random()[1], mixed)
+  with patch('vcg.videogen.ffmpegcli.run', wraps=run) as mock_run:
+    mixed = audio_mix(output, BGM.instance().random()[1], mixed)
+    # video stream is copied, not re-encoded
+    args = mock_run.call_args.args[0].compile()
+    assert args[args.index('-vcodec') + 1] == 'copy'
   valid, _ = validation(mixed)
   assert valid
+  assert size(mixed) == size(output)
+  assert duration(mixed) == pytest.approx(duration(output), abs=0.1)
+
+
+def test_output_mode(assets, tmp_path):
+  videos = generate(assets=assets, cwd=tmp_path)
+  output = concat(videos=videos, output=os.path.join(tmp_path, 'output.mp4'))
+  bgm = BGM.instance().random()[1]
+
+  # progressive mp4 has the index in front of the media data
+  data = Path(output).read_bytes()
+  assert data.index(b'moov') < data.index(b'mdat')
+
+  fragmented = audio_mix(output, bgm, os.path.join(tmp_path, 'fmp4.mp4'),
+                         mode='fmp4')
+  data = Path(fragmented).read_bytes()
+  assert b'moof' in data
+  assert data.index(b'moov') < data.index(b'mdat')
+  valid, _ = validation(fragmented)
+  assert valid
+
+  hls = audio_mix(output, bgm, os.path.join(tmp_path, 'hls.mp4'),
+                  mode='hls')
+  assert hls == os.path.join(tmp_path, 'hls.m3u8')
+  playlist = Path(hls).read_text()
+  assert '#EXT-X-ENDLIST' in playlist
+  segments = [line for line in playlist.splitlines()
+              if line.endswith('.m4s')]
+  assert len(segments) > 0
+  for segment in segments:
+    assert os.path.exists(os.path.join(tmp_path, segment))
+  assert os.path.exists(os.path.join(tmp_path, 'hls_init.mp4'))
+  valid, _ = validation(hls)
+  assert valid
+  assert duration(hls) == pytest.approx(duration(output), abs=0.5)
+
+  with pytest.raises(ValueError) as e:
+    output_file(output, 'mkv')
+  assert 'Unknown output mode' in str(e)
+
+
+def test_previews(assets, tmp_path):
+  videos = generate(assets=assets[:2], cwd=tmp_path)
+  output = concat(videos=videos, output=os.path.join(tmp_path, 'output.mp4'))
+  width, height = size(output)
+  columns, rows = pconf['sprite_tile']
+
+  mixed = os.path.join(tmp_path, 'mixed.mp4')
+  with patch('vcg.videogen.ffmpegcli.run', wraps=run) as mock_run:
+    audio_mix(output, BGM.instance().random()[1], mixed, with_previews=True)
+    # written by the same command
+    assert mock_run.call_count == 1
+  files = preview_files(mixed)
+  assert size(files['poster']) == (width, height)
+  sprite_height = round(pconf['sprite_width'] * height / width / 2) * 2
+  assert size(files['sprite']) == (
+    pconf['sprite_width'] * columns, sprite_height * rows)
+  data = Path(files['preview']).read_bytes()
+  assert data[:4] == b'RIFF' and data[8:12] == b'WEBP'
+  # animated webp
+  assert b'ANIM' in data
+
+  # gif preview, without background music
+  copied = os.path.join(tmp_path, 'copied.mp4')
+  with patch.dict(pconf, {'preview_format': 'gif'}):
+    concat_copy([output], copied, with_previews=True)
+    files = preview_files(copied)
+  assert files['preview'].endswith('_preview.gif')
+  assert os.path.exists(files['poster'])
+  probe = ffmpeg.probe(files['preview'], count_frames=None)
+  assert int(probe['streams'][0]['nb_read_frames']) == \
+    pconf['preview_time'] * pconf['preview_fps']
+  assert duration(copied) == pytest.approx(duration(output), abs=0.1)
+
+
+def test_render(assets, subtitles, tmp_path):
+  with pytest.raises(ValueError) as e:
+    render(assets=assets, subtitles=['random'],
+           output=os.path.join(tmp_path, 'output.mp4'))
+  assert 'must be the same' in str(e)
+
+  output, names = render(
+    assets=assets,
+    subtitles=subtitles,
+    bgm_file=BGM.instance().random()[1],
+    output=os.path.join(tmp_path, 'output.mp4'),
+    verbose=True,
+    with_previews=True,
+  )
+  assert len(names) == len(assets)
+  assert os.path.exists(output)
+  assert [*Path(tmp_path).glob('*.mp4')] == [Path(output)]
+  valid, _ = validation(output)
+  assert valid
+  for file in preview_files(output).values():
+    assert os.path.exists(file)
+  assert size(preview_files(output)['poster']) == size(output)
+
+
+def test_profile(assets, tmp_path):
+  draft = get_profile('draft')
+  videos = generate(assets=assets[:1], cwd=tmp_path, profile=draft)
+  outputs, _ = keyframe(videos=videos, cwd=tmp_path, profile=draft)
+  output = concat(
+    videos=outputs,
+    output=os.path.join(tmp_path, 'draft.mp4'),
+    profile=draft,
+  )
+  valid, _ = validation(output)
+  assert valid
+  assert size(output) == draft.size
+  probe = ffmpeg.probe(output)
+  vstream = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+  assert vstream['r_frame_rate'] == f'{draft.fps}/1'
+
+  with pytest.raises(ValueError) as e:
+    get_profile('not_exist')
+  assert 'Invalid render profile' in str(e.value)
+
+
+def test_ladder(assets, tmp_path):
+  videos = generate(assets=assets[:2], cwd=tmp_path)
+  output = concat(videos=videos, output=os.path.join(tmp_path, 'output.mp4'))
+
+  renditions = [
+    get_rendition({'size': [360, 640], 'bitrate': '500k', 'fps': 15}),
+    get_rendition({'size': [1280, 720], 'crf': 30}),
+  ]
+  with patch('vcg.videogen.ffmpegcli.run', wraps=run) as mock_run:
+    files = ladder(output, output, renditions)
+    # decoded once, split to all the renditions
+    assert mock_run.call_count == 1
+    args = mock_run.call_args.args[0].compile()
+    assert args.count('-i') == 1
+    assert 'split=2' in args[args.index('-filter_complex') + 1]
+
+  assert files == [
+    os.path.join(tmp_path, 'output_360x640_500k.mp4'),
+    os.path.join(tmp_path, 'output_1280x720_crf30.mp4'),
+  ]
+  for file, rendition in zip(files, renditions):
+    valid, _ = validation(file)
+    assert valid
+    assert size(file) == rendition.size
+    assert duration(file) == pytest.approx(duration(output), abs=0.1)
+  probe = ffmpeg.probe(files[0])
+  vstream = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+  assert vstream['r_frame_rate'] == '15/1'
+
+  with pytest.raises(ValueError) as e:
+    get_rendition({'bitrate': '500k'})
+  assert 'without size' in str(e.value)
+
+
+def test_render_renditions(assets, tmp_path):
+  renditions = [get_rendition({'size': [360, 640], 'bitrate': '500k'})]
+  output = os.path.join(tmp_path, 'output.mp4')
+  with patch('vcg.videogen.ffmpegcli.run', wraps=run) as mock_run:
+    output, _ = render(assets=assets[:2], output=output,
+                       with_previews=True, renditions=renditions)
+    # encoded in the render graph, split from the final video
+    assert mock_run.call_count == 1
+    args = mock_run.call_args.args[0].compile()
+    graph = args[args.index('-filter_complex') + 1]
+    assert 'split=3' in graph
+    assert 'asplit=2' in graph
+
+  files = rendition_files(output, renditions)
+  assert files == [os.path.join(tmp_path, 'output_360x640_500k.mp4')]
+  valid, _ = validation(files[0])
+  assert valid
+  assert size(files[0]) == renditions[0].size
+  assert duration(files[0]) == pytest.approx(duration(output), abs=0.1)
+  assert len(ffmpeg.probe(files[0], select_streams='a')['streams']) == 1
 
 
 @pytest.mark.asyncio
-@patch('vcg.videogen.activity.generate')
+@patch('vcg.videogen.activity.agenerate')
 async def test_generate_video(mock_generate, tmp_path, params):
   params['cwd'] = tmp_path
   mock_generate.return_value = params['videos']
@@ -147,21 +560,48 @@ async def test_generate_video(mock_generate, tmp_path, params):
   videos = await generate_video(params)
 
   mock_generate.assert_called_once()
+  assert mock_generate.call_args.kwargs['profile'].name == 'archive'
   assert videos == params['videos']
   assert os.path.exists(os.path.join(params['cwd'], 'video'))
 
 
 @pytest.mark.asyncio
-@patch('vcg.videogen.activity.keyframe')
-@patch('vcg.videogen.activity.audio_mix')
-@patch('vcg.videogen.activity.concat')
+@patch('vcg.videogen.activity.agenerate')
+async def test_generate_video_heartbeat(mock_generate, tmp_path, params):
+  params['cwd'] = tmp_path
+
+  def generate(**kwargs):
+    kwargs['progress']({'frame': 25, 'fps': 50.0, 'speed': 2.0,
+                        'out_time': 1.0, 'bitrate': 100.0, 'clip': 0})
+    return params['videos']
+  mock_generate.side_effect = generate
+
+  heartbeats = []
+  env = ActivityEnvironment()
+  env.on_heartbeat = lambda *details: heartbeats.append(details[0])
+  videos = await env.run(generate_video, params)
+  # let the event loop deliver the heartbeat
+  await asyncio.sleep(0)
+
+  assert videos == params['videos']
+  assert heartbeats[-1]['stage'] == 'generate'
+  assert heartbeats[-1]['frame'] == 25
+
+
+@pytest.mark.asyncio
+@patch('vcg.videogen.activity.duration')
+@patch('vcg.videogen.activity.akeyframe')
+@patch('vcg.videogen.activity.aaudio_mix')
+@patch('vcg.videogen.activity.aconcat')
 async def test_concat_video(
   mock_concat,
   mock_audio_mix,
   mock_keyframe,
+  mock_duration,
   tmp_path, params
 ):
   params['cwd'] = tmp_path
+  mock_duration.return_value = 60.0
 
   mock_concat.return_value = 'concat.mp4'
   mock_audio_mix.return_value = 'output.mp4'
@@ -170,19 +610,76 @@ async def test_concat_video(
     params['kfa'],
   )
 
-  final_output, bgm, kfa = await concat_video(params)
+  final_output, bgm, kfa, info = await concat_video(params)
 
   assert kfa == params['kfa']
   assert mock_keyframe.call_count == 1
   assert mock_keyframe.call_args.kwargs == {
     'videos': params['videos'],
     'cwd': os.path.join(params['cwd'], 'video'),
+    'subtitles': params['subtitles'],
+    'size': (720, 1280),
+    'workers': None,
+    'profile': mock_keyframe.call_args.kwargs['profile'],
+    'progress': mock_keyframe.call_args.kwargs['progress'],
+    'seed': params['id'],
   }
+  assert mock_keyframe.call_args.kwargs['profile'].name == 'archive'
 
   assert os.path.exists(os.path.join(params['cwd'], 'video'))
   assert mock_concat.call_count == 1
+  # burned by keyframe, joined by stream copy
+  assert 'subtitles' not in mock_concat.call_args.kwargs
 
   assert os.path.exists(bgm)
+  # the music fits the video
+  meta = BGM.instance().meta(os.path.basename(bgm))
+  assert 60.0 <= meta['duration'] <= 180.0
+  assert mock_duration.call_args.args == ('concat.mp4',)
   assert final_output == 'output.mp4'
+  assert 'elapsed' in info['encode']
   assert mock_audio_mix.call_count == 1
-  assert mock_audio_mix.call_args.args == ('concat.mp4', bgm)
+  wav, gain = BGM.instance().prepare(bgm)
+  assert mock_audio_mix.call_args.args == ('concat.mp4', wav)
+  assert mock_audio_mix.call_args.kwargs['bgm_volume'] == f'{gain}dB'
+  assert mock_audio_mix.call_args.kwargs['mode'] == 'mp4'
+  assert info['renditions'] == []
+  assert mock_audio_mix.call_args.kwargs['with_previews']
+  assert info['previews'] == preview_files(
+    os.path.join(params['cwd'], params['output']))
+
+
+@pytest.mark.asyncio
+@patch('vcg.videogen.activity.duration')
+@patch('vcg.videogen.activity.aladder')
+@patch('vcg.videogen.activity.arender')
+async def test_render_video(
+  mock_render,
+  mock_ladder,
+  mock_duration,
+  tmp_path, params
+):
+  params['cwd'] = tmp_path
+  params['renditions'] = [{'size': [360, 640], 'bitrate': '500k'}]
+  mock_duration.return_value = 10.0
+  mock_render.return_value = ('output.mp4', params['kfa'])
+
+  output, bgm, kfa, info = await render_video(params)
+
+  # renditions are encoded in the render graph, not from the output
+  mock_ladder.assert_not_called()
+  assert [r.name for r in mock_render.call_args.kwargs['renditions']] == [
+    '360x640_500k',
+  ]
+  assert info['renditions'] == [
+    os.path.join(tmp_path, 'output_360x640_500k.mp4'),
+  ]
+
+  mock_render.assert_called_once()
+  assert output == 'output.mp4'
+  assert kfa == params['kfa']
+  assert os.path.exists(bgm)
+  assert mock_render.call_args.kwargs['bgm_file'] == \
+    BGM.instance().prepare(bgm)[0]
+  assert mock_render.call_args.kwargs['output'] == os.path.join(
+    tmp_path, params['output'])
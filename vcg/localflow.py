@@ -9,7 +9,8 @@ from urlparser.activity import parse_url
 from textsummary.activity import summary_and_title
 from imageretrieval.activity import retrieve_image
 from speechsynthesis.activity import synthesize_speech
-from videogen.activity import generate_video, concat_video
+from videogen.activity import generate_video, concat_video, render_video
+from videogen.profile import profiles
 
 
 # use bgm testing dat if VCG_BGM_ROOT is not set
@@ -57,16 +58,21 @@ async def main(params):
   params['assets'] = [{'frames': frames[i], 'audio': audio[i]}
                       for i in range(len(frames))]
 
-  # generate video clips
-  params['videos'] = await generate_video(params)
-  if len(params['videos']) != len(audio):
-    raise RuntimeError('Number of video and audio clips do not match')
-
-  # concat video clips
   params['output'] = f'{params["title"]}.mp4'
-  output, bgm, kfa = await concat_video(params)
+  if params.get('fused', False):
+    # render the final video in a single pass
+    output, bgm, kfa, info = await render_video(params)
+  else:
+    # generate video clips
+    params['videos'] = await generate_video(params)
+    if len(params['videos']) != len(audio):
+      raise RuntimeError('Number of video and audio clips do not match')
+
+    # concat video clips
+    output, bgm, kfa, info = await concat_video(params)
   print(f'BGM: {bgm}')
   print(f'Keyframe animations: {kfa}')
+  print(f'Encoding: {info["encode"]}')
   print(f'Final output: {output}')
 
   return output
@@ -79,6 +85,9 @@ def parse_args():
   parser.add_argument('--url', type=str)
   parser.add_argument('--voice-ali', type=str)
   parser.add_argument('--prompter', type=str)
+  parser.add_argument('--fused', action='store_true')
+  parser.add_argument('--profile', choices=list(profiles))
+  parser.add_argument('--output-mode', choices=['mp4', 'fmp4', 'hls'])
 
   args = parser.parse_args()
   print(f'params: {args.params}')
@@ -96,6 +105,12 @@ def parse_args():
       params['voice_ali'] = args.voice_ali
     if args.prompter:
       params['prompter'] = args.prompter
+    if args.fused:
+      params['fused'] = True
+    if args.profile:
+      params['profile'] = args.profile
+    if args.output_mode:
+      params['output_mode'] = args.output_mode
 
     if 'url' not in params:
       raise RuntimeError('URL is not set')
@@ -54,18 +54,20 @@ async def main(params):
                       for i in range(len(audio))]
 
   # generate video clips
+  # images are normalized for the landscape canvas of the output
+  params['size'] = (1280, 720)
   params['videos'] = await generate_video(params)
   if len(params['videos']) != len(audio):
     raise RuntimeError('Number of video and audio clips do not match')
 
   # concat video clips
   title = params['title'] if 'title' in params else 'Untitled'
-  params['size'] = (1280, 720)
   params['output'] = f'{title}.mp4'
-  output, bgm, kfa = await concat_video(params)
+  output, bgm, kfa, info = await concat_video(params)
 
   print(f'BGM: {bgm}')
   print(f'Keyframe animations: {kfa}')
+  print(f'Encoding: {info["encode"]}')
   print(f'Final output: {output}')
 
   return output
@@ -9,6 +9,8 @@ from temporalio import workflow
 from temporalio.client import Client
 from temporalio.worker import Worker
 
+from temporalio.api.common.v1 import WorkflowExecution
+from temporalio.api.workflowservice.v1 import DescribeWorkflowExecutionRequest
 from temporalio.common import RetryPolicy
 from temporalio.exceptions import ApplicationError, FailureError
 
@@ -39,7 +41,10 @@ with workflow.unsafe.imports_passed_through():
   from urlparser.activity import parse_url
   from textsummary.activity import summary_and_title
   from speechsynthesis.activity import synthesize_speech
-  from videogen.activity import generate_video, concat_video
+  from videogen.activity import generate_video, concat_video, render_video
+  from videogen.activity import index_bgm
+  from videogen.profile import default_profile, get_rendition
+  from videogen.ffmpegcli import output_file, rendition_file, preview_files
 
 
 @workflow.defn
@@ -69,6 +74,11 @@ class VideoClipGen:
 
   @workflow.query(name='progress')
   def query(self) -> str:
+    """
+    Progress of the workflow. Encode stats of the video activities are only
+    known to the workflow once they return, live ffmpeg progress is sent as
+    heartbeats, see query_progress().
+    """
     return json.dumps(self._progress)
 
   @workflow.run
@@ -96,6 +106,13 @@ class VideoClipGen:
     # TODO More TTS services besides aliyun
     if 'voice_ali' in params:
       params['voice'] = params['voice_ali']
+    # render quality profile, one of videogen.profile.profiles
+    if 'profile' not in params:
+      params['profile'] = default_profile
+    self._progress['profile'] = params['profile']
+    # container of the final video: mp4, fmp4 or hls
+    if 'output_mode' not in params:
+      params['output_mode'] = 'mp4'
 
     # prepare workspace for data storage
     params['cwd'] = await workflow.execute_activity(
@@ -193,61 +210,135 @@ class VideoClipGen:
 
     # update workflow status
     self._set_progress('video', 'running')
-
-    try:
-      # generate video clips
-      params['videos'] = await workflow.execute_activity(
-        'generate_video',
-        params,
-        # task_queue='video-generation',
-        schedule_to_close_timeout=timedelta(seconds=180),
-        retry_policy=retry_policy,
-      )
-    except FailureError as e:
-      # update status
-      self._set_progress('video', 'error', 'VideoGenError')
-      logging.exception(e.message)
-      raise ApplicationError('Failed to generate videos.', e)
-
-    if len(params['videos']) != len(audio):
-      self._set_progress('video', 'error', 'VideoGenError')
-      raise ApplicationError('Number of video and audio clips do not match')
-
-    # concat video clips
-    try:
-      params['video'], params['bgm'], params['kfa'] = (
-        await workflow.execute_activity(
-          'concat_video',
+    if params.get('fused', False) and params['output_mode'] != 'mp4':
+      # fragmented outputs can be played while being encoded, the fused
+      # render writes the output from the start with segment-aligned GOPs,
+      # while concat_video only remuxes the joined video into it at the end
+      self._progress['output'] = '/'.join([
+        params['id'], output_file(params['output'], params['output_mode']),
+      ])
+
+    if params.get('fused', False):
+      # render the final video in a single pass
+      try:
+        params['video'], params['bgm'], params['kfa'], info = (
+          await workflow.execute_activity(
+            'render_video',
+            params,
+            # task_queue='video-generation',
+            schedule_to_close_timeout=timedelta(seconds=300),
+            heartbeat_timeout=timedelta(seconds=60),
+            retry_policy=retry_policy,
+          )
+        )
+      except FailureError as e:
+        # update status
+        self._set_progress('video', 'error', 'VideoRenderError')
+        logging.exception(e.message)
+        raise ApplicationError('Failed to render video.', e)
+    else:
+      try:
+        # generate video clips
+        params['videos'] = await workflow.execute_activity(
+          'generate_video',
           params,
           # task_queue='video-generation',
           schedule_to_close_timeout=timedelta(seconds=180),
+          # ffmpeg progress is sent as heartbeats, fail fast on stuck encodes
+          heartbeat_timeout=timedelta(seconds=60),
           retry_policy=retry_policy,
         )
-      )
-    except FailureError as e:
-      # update status
-      self._set_progress('video', 'error', 'VideoConcatError')
-      logging.exception(e.message)
-      raise ApplicationError('Failed to concat videos.', e)
+      except FailureError as e:
+        # update status
+        self._set_progress('video', 'error', 'VideoGenError')
+        logging.exception(e.message)
+        raise ApplicationError('Failed to generate videos.', e)
+
+      if len(params['videos']) != len(audio):
+        self._set_progress('video', 'error', 'VideoGenError')
+        raise ApplicationError('Number of video and audio clips do not match')
+
+      # concat video clips
+      try:
+        params['video'], params['bgm'], params['kfa'], info = (
+          await workflow.execute_activity(
+            'concat_video',
+            params,
+            # task_queue='video-generation',
+            schedule_to_close_timeout=timedelta(seconds=180),
+            heartbeat_timeout=timedelta(seconds=60),
+            retry_policy=retry_policy,
+          )
+        )
+      except FailureError as e:
+        # update status
+        self._set_progress('video', 'error', 'VideoConcatError')
+        logging.exception(e.message)
+        raise ApplicationError('Failed to concat videos.', e)
 
     # update workflow status
+    self._progress['video']['encode'] = info['encode']
     self._set_progress('video', 'success')
     self._progress['title'] = params['title']
-    self._progress['output'] = '/'.join([params['id'], params['output']])
+    self._progress['output'] = '/'.join([
+      params['id'], output_file(params['output'], params['output_mode']),
+    ])
+    # lower resolution/bitrate variants of the output
+    self._progress['renditions'] = [
+      '/'.join([params['id'], output_file(
+        rendition_file(params['output'], get_rendition(r)),
+        params['output_mode'],
+      )])
+      for r in params.get('renditions', [])
+    ]
+    # poster, sprite and animated preview of the output
+    self._progress['previews'] = {
+      name: '/'.join([params['id'], file])
+      for name, file in preview_files(params['output']).items()
+      if name in info.get('previews', {})
+    }
 
     return params
 
 
+async def query_progress(client: Client, workflow_id: str) -> dict:
+  """
+  Progress of a VideoClipGen workflow, along with the live ffmpeg progress
+  of its running activities, the last heartbeat details of each pending
+  activity in `live`, e.g. {'concat_video': {'stage': 'keyframe', ...}}.
+  """
+  handle = client.get_workflow_handle(workflow_id)
+  progress = json.loads(await handle.query('progress'))
+
+  response = await client.workflow_service.describe_workflow_execution(
+    DescribeWorkflowExecutionRequest(
+      namespace=client.namespace,
+      execution=WorkflowExecution(workflow_id=workflow_id),
+    )
+  )
+  progress['live'] = {}
+  for pending in response.pending_activities:
+    payloads = pending.heartbeat_details.payloads
+    if len(payloads) == 0:
+      continue
+    details = await client.data_converter.decode(payloads)
+    progress['live'][pending.activity_type.name] = details[-1]
+  return progress
+
+
 async def main(client: Client, task_queue: str):
   print('Starting workflow VideoClipGen...')
   print(f'Using task queue {task_queue}...')
+  # index the music library before taking any task
+  await asyncio.to_thread(index_bgm)
 
   # Create client connected to server at the given address
   worker = Worker(
     client,
     task_queue=task_queue,
     activities=[prepare, parse_url, summary_and_title,
-                synthesize_speech, generate_video, concat_video],
+                synthesize_speech, generate_video, concat_video,
+                render_video],
     workflows=[VideoClipGen]
   )
   await worker.run()
@@ -259,6 +350,8 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument('--server', default='localhost:7233')
   parser.add_argument('--task-queue', default='vcg')
+  parser.add_argument('--progress', metavar='WORKFLOW_ID',
+                      help='print the live progress of a workflow and exit')
   args = parser.parse_args()
   server = args.server
   task_queue = args.task_queue
@@ -266,6 +359,10 @@ if __name__ == '__main__':
   async def connect():
     print(f'Connecting to server at {server}...')
     client = await Client.connect(server)
+    if args.progress is not None:
+      progress = await query_progress(client, args.progress)
+      print(json.dumps(progress, ensure_ascii=False, indent=2))
+      return
     await main(client, task_queue)
 
   asyncio.run(connect())
@@ -0,0 +1,258 @@
+# Path: urlparser/downloader.py
+
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+from videogen.cache import FileCache
+
+
+def local_name(url: str, ext='.jpg') -> str:
+  """
+  File name of a downloaded url, the sha1 of the url.
+  """
+  return sha1(url.encode('utf-8')).hexdigest() + ext
+
+
+# bytes read at most to find out the format and size of an image
+probe_bytes = 64 << 10
+
+
+class Skipped(Exception):
+  """
+  Raised when a download is skipped by its check, see Downloader.download().
+  """
+
+
+def probe(data) -> tuple[str, int, int] | None:
+  """
+  Get (format, width, height) of an image from its first bytes or file
+  path, None if they are not enough or not an image.
+  """
+  try:
+    source = io.BytesIO(data) if isinstance(data, bytes) else data
+    # only the header is read
+    with Image.open(source) as image:
+      return image.format, image.width, image.height
+  except (OSError, EOFError, ValueError):
+    return None
+
+
+def download_cache() -> FileCache | None:
+  """
+  Get the download cache of VCG_DOWNLOAD_CACHE, sized by
+  VCG_DOWNLOAD_CACHE_SIZE in MB, None if VCG_DOWNLOAD_CACHE is empty.
+  """
+  root = os.getenv(
+    'VCG_DOWNLOAD_CACHE',
+    default=os.path.join(tempfile.gettempdir(), 'vcg-download'),
+  )
+  if not root:
+    return None
+  max_bytes = int(os.getenv('VCG_DOWNLOAD_CACHE_SIZE', default=4096)) << 20
+  return FileCache(root, max_bytes=max_bytes)
+
+
+class Downloader:
+  """
+  Download files concurrently, `workers` at a time, over a pool of
+  keep-alive connections. Requests time out after `timeout` seconds
+  (connect, read) and failed ones (connection errors, 429 and 5xx) are
+  retried `retries` times with exponential backoff.
+
+  Downloads are cached on the host, shared by all workers, and hardlinked
+  into the workspaces. The cache maps sha1 of the url to sha1 of the
+  content and the header of the image (a json entry), and stores the
+  content by its sha1, so the same image behind different urls is stored
+  once. Images skipped by their headers are only cached as json entries.
+  """
+
+  def __init__(self, workers=None, timeout=None, retries=3, backoff=0.5,
+               cache=None):
+    self._workers = workers or int(os.getenv(
+      'VCG_DOWNLOAD_WORKERS',
+      default=8,
+    ))
+    self._timeout = timeout or (
+      5.0,
+      float(os.getenv('VCG_DOWNLOAD_TIMEOUT', default=30.0)),
+    )
+
+    retry = Retry(
+      total=retries,
+      backoff_factor=backoff,
+      status_forcelist=[429, 500, 502, 503, 504],
+      allowed_methods=['GET'],
+    )
+    # one connection per worker and host
+    adapter = HTTPAdapter(pool_maxsize=self._workers, max_retries=retry)
+    self._session = requests.Session()
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
+    self._cache = cache if cache is not None else download_cache()
+
+  def _entry(self, url) -> dict:
+    """
+    Cache entry of the url: sha1 of the content, and header of the image,
+    an empty dict on miss.
+    """
+    if self._cache is None:
+      return {}
+    data = self._cache.read(sha1(url.encode('utf-8')).hexdigest(), '.json')
+    if data is None:
+      return {}
+    try:
+      return json.loads(data)
+    except ValueError:
+      return {}
+
+  def _cache_put(self, url, local_path, content, header):
+    if self._cache is None:
+      return
+    if content is not None:
+      # the same content may be cached from another url, share it
+      if not self._cache.get(content, local_path):
+        # evicted once after all downloads, see download_all()
+        self._cache.put(content, local_path, evict=False)
+    self._cache.write(
+      sha1(url.encode('utf-8')).hexdigest(),
+      json.dumps({'url': url, 'sha1': content, 'header': header})
+      .encode('utf-8'),
+      '.json', evict=False,
+    )
+
+  def _check(self, url, header, check):
+    if header is not None and not check(url, *header):
+      raise Skipped(f'Skipped {header[0]} image{tuple(header[1:])}: {url}')
+
+  def _fetch(self, source, url, local_path, key, header, check):
+    """
+    Stream `source` to `local_path`, return sha1 of the content and the
+    header of the image. Skipped images are cached by `key` with headers.
+    """
+    s1 = sha1()
+    head = b''
+    temp = f'{local_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+      with self._session.get(
+          source, stream=True, timeout=self._timeout) as r:
+        r.raise_for_status()
+        with open(temp, 'wb') as fp:
+          for chunk in r.iter_content(chunk_size=8 << 10):
+            fp.write(chunk)
+            s1.update(chunk)
+            if header is None and len(head) < probe_bytes:
+              head += chunk
+              header = probe(head)
+              if header is not None and check is not None:
+                try:
+                  self._check(url, header, check)
+                except Skipped:
+                  # the rest of the body is not read
+                  self._cache_put(key, None, None, header)
+                  raise
+      # never leave a partial file under the final name
+      os.replace(temp, local_path)
+    finally:
+      if os.path.exists(temp):
+        os.remove(temp)
+    return s1.hexdigest(), header
+
+  def download(self, url: str, path: str, check=None, variant=None) -> str:
+    """
+    Download the url to `path`, named by local_name(), return the file.
+    Files downloaded or cached already are not downloaded again.
+
+    `check(url, format, width, height)` is called once the header of the
+    image is read, the download is stopped by raising Skipped if it
+    returns False. Images of unknown formats are not checked.
+
+    `variant` is the url of a smaller variant of the image, downloaded
+    instead of the url, which is the fallback if the variant fails.
+    The downloaded file is cached by the variant.
+    """
+    os.makedirs(path, exist_ok=True)
+    local_path = os.path.join(path, local_name(url))
+    key = variant or url
+    entry = self._entry(key)
+    header = entry.get('header')
+    if os.path.exists(local_path) or (
+        entry.get('sha1') and self._cache.get(entry['sha1'], local_path)):
+      if check is not None:
+        try:
+          self._check(url, header or probe(local_path), check)
+        except Skipped:
+          os.remove(local_path)
+          raise
+      return local_path
+    if check is not None and header is not None:
+      # skipped before, and not downloaded at all
+      self._check(url, header, check)
+
+    try:
+      content, header = self._fetch(
+        key, url, local_path, key, header, check)
+    except requests.RequestException as e:
+      if key == url:
+        raise
+      logging.warning(f'Failed to download {key}, fall back to {url}: {e}')
+      content, header = self._fetch(
+        url, url, local_path, key, None, check)
+
+    self._cache_put(key, local_path, content, header)
+    return local_path
+
+  def download_all(self, urls: list[str], path: str, check=None,
+                   variant=None) -> list[str | None]:
+    """
+    Download the urls concurrently, the files are returned in the same order
+    as the urls, None for the failed and skipped ones, see download().
+    `variant(url)` returns the url of a smaller variant of the image, or
+    None if there is not any.
+    """
+
+    def download(url):
+      try:
+        return self.download(
+          url, path, check=check,
+          variant=variant(url) if variant is not None else None,
+        )
+      except Skipped as e:
+        logging.info(e)
+        return None
+      except (requests.RequestException, OSError) as e:
+        logging.error(f'Failed to download {url}: {e}')
+        return None
+
+    if len(urls) == 0:
+      return []
+    workers = max(1, min(self._workers, len(urls)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      files = list(executor.map(download, urls))
+
+    if self._cache is not None:
+      self._cache.evict()
+    return files
+
+  @property
+  def workers(self):
+    return self._workers
+
+  _singleton = None
+
+  @classmethod
+  def instance(cls):
+    if Downloader._singleton is None:
+      Downloader._singleton = Downloader()
+    return Downloader._singleton
@@ -0,0 +1,62 @@
+# Path: urlparser/imagefilter.py
+
+import os
+
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ImageFilter:
+  """
+  Skip decorative images of articles by their sizes, which are known from
+  the first few KB of the images, before downloading them.
+  """
+  # dividers: thin strips, width/height, or height/width, no less than this
+  # and thinner than `min_size`
+  divider_ratio: float = 6.0
+  # icons, emojis and bullets: width or height smaller than this
+  min_size: int = 120
+  # banners: width/height no less than this, see retrieval.retrieve()
+  max_ratio: float = 2.0
+  # QR codes: square and no larger than this, 0 to keep square images
+  qrcode_size: int = 480
+
+  @classmethod
+  def from_env(cls):
+    """
+    Thresholds of VCG_IMAGE_FILTER_{DIVIDER_RATIO, MIN_SIZE, MAX_RATIO,
+    QRCODE_SIZE}, defaults for the unset ones.
+    """
+    default = cls()
+    return cls(
+      divider_ratio=float(os.getenv(
+        'VCG_IMAGE_FILTER_DIVIDER_RATIO', default=default.divider_ratio)),
+      min_size=int(os.getenv(
+        'VCG_IMAGE_FILTER_MIN_SIZE', default=default.min_size)),
+      max_ratio=float(os.getenv(
+        'VCG_IMAGE_FILTER_MAX_RATIO', default=default.max_ratio)),
+      qrcode_size=int(os.getenv(
+        'VCG_IMAGE_FILTER_QRCODE_SIZE', default=default.qrcode_size)),
+    )
+
+  def reason(self, size: tuple[int, int]) -> str | None:
+    """
+    Reason to skip an image of size(width, height), None to keep it.
+    """
+    width, height = size
+    if width <= 0 or height <= 0:
+      return 'empty'
+    ratio = width / height
+    # long infographics and screenshots are not thin
+    if max(ratio, 1 / ratio) >= self.divider_ratio and \
+       min(width, height) < self.min_size:
+      return 'divider'
+    if width < self.min_size or height < self.min_size:
+      return 'icon'
+    if ratio >= self.max_ratio:
+      return 'banner'
+    # allow a few pixels of margin
+    if abs(width - height) <= max(width, height) * 0.02 and \
+       max(width, height) <= self.qrcode_size:
+      return 'qrcode'
+    return None
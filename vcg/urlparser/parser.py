@@ -2,30 +2,29 @@
 import argparse
 import ffmpeg
 import json
+import logging
 import os
+import re
+import shutil
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from hashlib import sha1
 from bs4 import BeautifulSoup
+from lxml import etree
+from PIL import Image, ImageSequence, UnidentifiedImageError
 import urllib.request as request
+from urllib.parse import urlsplit, urlunsplit
 from pprint import pprint
 
+from urlparser.downloader import Downloader
+from urlparser.imagefilter import ImageFilter
+from videogen.scheduler import Scheduler
 
-# 将图片保存到本地
-def download_img(url: str, path: str) -> str:
-  if not os.path.exists(path):
-    os.makedirs(path)
-  s1 = sha1()
-  s1.update(url.encode("utf-8"))
-  local_path = os.path.join(path, s1.hexdigest() + '.jpg')
-  return request.urlretrieve(url, local_path)[0]
 
-
-def build_soup(url: str) -> BeautifulSoup:
+def fetch_html(url: str) -> str:
   resource = request.urlopen(url)
-  html = resource.read().decode(resource.headers.get_content_charset())
-  soup = BeautifulSoup(html, 'lxml')
-  return soup
+  return resource.read().decode(resource.headers.get_content_charset())
 
 
 def get_metadata(soup: BeautifulSoup) -> dict[str, str]:
@@ -66,28 +65,148 @@ def get_paragraphs(body) -> list[str]:
   return paragraphs
 
 
-def get_images(body, path: str) -> list[str]:
-  image_paths = []
+def get_image_urls(body) -> list[str]:
+  return [image.get('data-src') for image in body.find_all('img')
+          if image.get('data-src')]
 
-  # 文章中的所有图片
-  images = body.find_all('img')
-  for image in images:
-    src = image.get('data-src')
-    if src:
-      new_src = download_img(src, path)
-      print(new_src)
-      image_paths.append(new_src)
-      # 前端图片展示时需要用延迟加载
-      image['data-src'] = new_src
 
-  return image_paths
+def extract_soup(html: str) -> tuple[list[str], list[str], dict[str, str]]:
+  """
+  Extract sentences, image urls and metadata of an article with
+  BeautifulSoup.
+  """
+  soup = BeautifulSoup(html, 'lxml')
+  body = soup.find(id='activity-detail')
+  return get_paragraphs(body), get_image_urls(body), get_metadata(soup)
 
 
-def split_frames(images, outdir):
-  if not os.path.exists(outdir):
-    os.makedirs(outdir)
+# properties of metadata, in <meta property="og:*" content="...">
+og_properties = {
+  'title': 'og:title',
+  'url': 'og:url',
+  'desc': 'og:description',
+  'image': 'og:image',
+}
+_og = etree.XPath('(//*[@property=$name])[1]/@content')
+_body = etree.XPath('(//*[@id="activity-detail"])[1]')
+_content = etree.XPath('(.//*[@id="js_content"])[1]')
+# text as BeautifulSoup's get_text(), without scripts, styles and templates
+_texts = etree.XPath(
+  './/text()[not(ancestor::script or ancestor::style or ancestor::template)]'
+)
+_image_urls = etree.XPath('.//img[@data-src != ""]/@data-src')
+
+
+def extract_lxml(html: str) -> tuple[list[str], list[str], dict[str, str]]:
+  """
+  Extract sentences, image urls and metadata of an article with lxml and
+  precompiled XPath, the same as extract_soup() in a single parse of the
+  page and without building a BeautifulSoup tree.
+  """
+  tree = etree.fromstring(html, etree.HTMLParser())
+  metadata = {}
+  for key, name in og_properties.items():
+    content = _og(tree, name=name)
+    metadata[key] = str(content[0]) if content else str(None)
+
+  body = _body(tree)[0]
+  text = ''.join([s.strip() for s in _texts(_content(body)[0])])
+  separator = '。'
+  sentences = [s + separator for s in text.split(separator)]
+  return sentences, [str(url) for url in _image_urls(body)], metadata
+
+
+# extraction backends, lxml is the default
+extractors = {
+  'lxml': extract_lxml,
+  'soup': extract_soup,
+}
+
+
+def extract(html: str, backend=None) -> tuple[
+    list[str], list[str], dict[str, str]]:
+  """
+  Extract sentences, image urls and metadata of an article with the backend
+  of VCG_PARSER_BACKEND, see extractors.
+  """
+  backend = backend or os.getenv('VCG_PARSER_BACKEND', default='lxml')
+  if backend not in extractors:
+    raise ValueError(f'Unknown parser backend: {backend}')
+  return extractors[backend](html)
+
+
+# images of articles on the WeChat CDN, /{type}/{id}/{width}, e.g.
+# https://mmbiz.qpic.cn/mmbiz_jpg/{id}/640?wx_fmt=jpeg, width 0 is original
+_mmbiz = re.compile(r'^/(mmbiz(?:_\w+)?)/([^/]+)/(\d+)/?$')
+
+
+def variant_url(url: str, width: int) -> str | None:
+  """
+  Url of the `width` pixels wide variant of an image on the WeChat CDN,
+  None if there is not any. Animated gifs are not resized by the CDN.
+  """
+  parts = urlsplit(url)
+  match = _mmbiz.match(parts.path)
+  if not (parts.hostname or '').endswith('.qpic.cn') or match is None:
+    return None
+  kind, name, _ = match.groups()
+  if kind == 'mmbiz_gif' or 'wx_fmt=gif' in parts.query:
+    return None
+  return urlunsplit(parts._replace(path=f'/{kind}/{name}/{width}'))
 
-  for i, image in enumerate(images):
+
+def download_images(urls: list[str], path: str, image_filter=None,
+                    variant_width=None) -> tuple[list[str], list[dict]]:
+  """
+  Download images concurrently, in the order of the images. Images are
+  checked by `image_filter` once their headers are read, the skipped ones
+  are not downloaded, and returned with the reasons.
+
+  Images on the WeChat CDN are downloaded as `variant_width` pixels wide
+  variants if given, or the originals if the variants fail.
+  """
+  skipped = {}
+
+  def check(url, format, width, height):
+    reason = image_filter.reason((width, height))
+    if reason is not None:
+      skipped[url] = {
+        'url': url,
+        'reason': reason,
+        'format': format,
+        'size': [width, height],
+      }
+    return reason is None
+
+  files = Downloader.instance().download_all(
+    urls, path,
+    check=check if image_filter is not None else None,
+    variant=partial(variant_url, width=variant_width)
+    if variant_width else None,
+  )
+  return (
+    [file for file in files if file is not None],
+    [skipped[url] for url in dict.fromkeys(urls) if url in skipped],
+  )
+
+
+# 10 frames maximum of animated images
+max_frames = 10
+
+
+def _link(src, dst):
+  if os.path.exists(dst):
+    os.remove(dst)
+  try:
+    os.link(src, dst)
+  except OSError:
+    # across file systems
+    shutil.copyfile(src, dst)
+
+
+def _ffmpeg_frames(image, outdir, i) -> list[str]:
+  # share the host ffmpeg slots with the video workers
+  with Scheduler.instance().slot() as threads:
     stream = ffmpeg.input(image)
     stream = ffmpeg.output(
       stream,
@@ -96,21 +215,75 @@ def split_frames(images, outdir):
       # fps_mode='passthrough',
       vsync=0,
       pix_fmt='yuvj420p',
-      # 10 frames maximum
-      vframes=10,
+      vframes=max_frames,
+      threads=threads,
     )
     ffmpeg.run(stream, quiet=True)
+  return sorted(
+    [str(p) for p in Path(outdir).glob(f'{i}-*.jpg')],
+    key=lambda p: int(Path(p).stem.split('-')[1]),
+  )
 
-  return [str(p) for p in Path(outdir).glob('**/*.jpg')]
 
+def extract_frames(image, outdir, i) -> list[str]:
+  """
+  Extract the frames of the i-th image to `outdir` as {i}-{n}.jpg, n from 1.
+  Static JPEGs are linked as they are, other static images are converted
+  to JPEG, animated images(gif, webp) are expanded to `max_frames` frames
+  at most. Images Pillow cannot decode fall back to ffmpeg.
+  """
+  try:
+    with Image.open(image) as im:
+      if not getattr(im, 'is_animated', False):
+        output = os.path.join(outdir, f'{i}-1.jpg')
+        if im.format == 'JPEG' and im.mode in ('RGB', 'L'):
+          _link(image, output)
+        else:
+          im.convert('RGB').save(output, format='JPEG', quality=95)
+        return [output]
+
+      frames = []
+      for n, frame in enumerate(ImageSequence.Iterator(im), start=1):
+        if n > max_frames:
+          break
+        output = os.path.join(outdir, f'{i}-{n}.jpg')
+        frame.convert('RGB').save(output, format='JPEG', quality=95)
+        frames.append(output)
+      return frames
+  except (UnidentifiedImageError, OSError) as e:
+    logging.warning(f'Extract frames of {image} with ffmpeg: {e}')
+    return _ffmpeg_frames(image, outdir, i)
+
+
+def split_frames(images, outdir, workers=None) -> list[str]:
+  """
+  Extract the frames of images concurrently, see extract_frames().
+  Frames are returned in the order of the images.
+  """
+  if not os.path.exists(outdir):
+    os.makedirs(outdir)
+  if len(images) == 0:
+    return []
+
+  # Pillow releases the GIL when decoding and encoding
+  workers = max(1, min(workers or os.cpu_count() or 1, len(images)))
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    frames = executor.map(
+      lambda args: extract_frames(args[1], outdir, args[0]),
+      enumerate(images),
+    )
+    return [frame for image_frames in frames for frame in image_frames]
 
-def parse(url: str, path: str) -> tuple[list[str], list[str], dict[str, str]]:
-  soup = build_soup(url)
-  body = soup.find(id='activity-detail')
 
-  metadata = get_metadata(soup)
-  sentences = get_paragraphs(body)
-  images = get_images(body, os.path.join(path, 'tmpimages'))
+def parse(url: str, path: str, backend=None) -> tuple[
+    list[str], list[str], dict[str, str]]:
+  sentences, urls, metadata = extract(fetch_html(url), backend)
+  images, skipped = download_images(
+    urls, os.path.join(path, 'tmpimages'), ImageFilter.from_env(),
+    variant_width=int(os.getenv('VCG_IMAGE_VARIANT_WIDTH', default=0)),
+  )
+  # decorative images(banners, dividers, QR codes and icons) skipped
+  metadata['skipped'] = skipped
 
   with open(os.path.join(path, 'sentences.json'), 'w') as fp:
     json.dump(sentences, fp, ensure_ascii=False, indent=2)
@@ -1,10 +1,80 @@
+import asyncio
+import contextvars
 import os
-import shutil
+import time
 
 from temporalio import activity
 
 from videogen.bgm import BGM
-from videogen.ffmpegcli import generate, keyframe, concat, audio_mix
+from videogen.ffmpegcli import agenerate, akeyframe, aconcat, aaudio_mix
+from videogen.ffmpegcli import aconcat_copy, aladder, arender, duration
+from videogen.ffmpegcli import preview_files, rendition_files
+from videogen.profile import get_profile, get_rendition
+
+
+class Telemetry:
+  """
+  Collect ffmpeg progress of an activity and forward it as heartbeats.
+  Progress callbacks may be invoked from any thread.
+  """
+
+  def __init__(self):
+    self._loop = asyncio.get_running_loop()
+    self._context = contextvars.copy_context()
+    self._start = time.monotonic()
+    self._stats = {}
+
+  def stage(self, name):
+    """
+    Progress callback of the given stage.
+    """
+
+    def callback(info):
+      info = {'stage': name, **info}
+      self._stats[name] = info
+      # heartbeat must be sent from the event loop of the activity
+      self._loop.call_soon_threadsafe(
+        activity.heartbeat, info,
+        context=self._context,
+      )
+    return callback
+
+  @property
+  def stats(self) -> dict:
+    """
+    The last progress of each stage, and the elapsed time in seconds.
+    """
+    return {
+      **self._stats,
+      'elapsed': round(time.monotonic() - self._start, 3),
+    }
+
+
+def index_bgm():
+  """
+  Index the music library at worker startup if VCG_BGM_ROOT is set, so
+  activities do not probe a large library on a cold start.
+  """
+  if os.getenv('VCG_BGM_ROOT') is not None:
+    BGM.instance()
+
+
+async def encode_renditions(params, video, profile, telemetry) -> list[str]:
+  """
+  Encode the renditions in params of the final video, in a single pass.
+  render_video() encodes them in its own graph instead.
+  """
+  if 'renditions' not in params or len(params['renditions']) == 0:
+    return []
+
+  return await aladder(
+    video,
+    output=os.path.join(params['cwd'], params['output']),
+    renditions=[get_rendition(r) for r in params['renditions']],
+    profile=profile,
+    progress=telemetry.stage('renditions'),
+    mode=params['output_mode'] if 'output_mode' in params else 'mp4',
+  )
 
 
 @activity.defn(name='generate_video')
@@ -15,38 +85,139 @@ async def generate_video(params) -> list[str]:
   if not os.path.exists(workspace):
     os.makedirs(workspace)
 
-  return generate(assets=params['assets'], cwd=workspace)
+  telemetry = Telemetry()
+  return await agenerate(
+    assets=params['assets'],
+    cwd=workspace,
+    workers=params['workers'] if 'workers' in params else None,
+    profile=get_profile(params['profile'] if 'profile' in params else None),
+    progress=telemetry.stage('generate'),
+    size=params['size'] if 'size' in params else None,
+  )
 
 
 @activity.defn(name='concat_video')
-async def concat_video(params) -> tuple[str, str, list[str]]:
+async def concat_video(params) -> tuple[str, str, list[str], dict]:
   print('Concatenating video...')
 
+  telemetry = Telemetry()
+  profile = get_profile(params['profile'] if 'profile' in params else None)
   workspace = os.path.join(params['cwd'], 'video')
   if not os.path.exists(workspace):
     os.makedirs(workspace)
 
   # HACK hardcoded keyframe animations
-  videos, kfa = keyframe(videos=params['videos'], cwd=workspace)
+  # scale/pad and subtitles are applied per clip along with the animation,
+  # which encodes anyway, so that concatenation is a stream copy
+  size = params['size'] if 'size' in params else profile.size
+  videos, kfa = await akeyframe(
+    videos=params['videos'],
+    cwd=workspace,
+    subtitles=params['subtitles'] if 'subtitles' in params else None,
+    size=size,
+    workers=params['workers'] if 'workers' in params else None,
+    profile=profile,
+    progress=telemetry.stage('keyframe'),
+    # same animations on retries, so the clips are taken from the cache
+    seed=params['id'] if 'id' in params else None,
+  )
 
   # TODO dont generate temp file, use ffmpeg pipe instead
-  temp = concat(
+  temp = await aconcat(
     videos=videos,
-    subtitles=params['subtitles'] if 'subtitles' in params else None,
-    size=params['size'] if 'size' in params else None,
+    size=size,
     output=os.path.join(params['cwd'], 'temp.mp4'),
+    profile=profile,
+    progress=telemetry.stage('concat'),
   )
 
   # add background music
+  # the final video is written in the output mode: mp4, fmp4 or hls
   output = os.path.join(params['cwd'], params['output'])
-  _, bgm_file = BGM.instance().random()
+  mode = params['output_mode'] if 'output_mode' in params else 'mp4'
+  # poster, sprite and preview are written by the final command
+  with_previews = params['previews'] if 'previews' in params else True
+  previews = preview_files(output) if with_previews else {}
+  # heartbeats are sent while the music library is indexed
+  bgm_file = await asyncio.to_thread(
+    lambda: BGM.instance(progress=telemetry.stage('bgm')).random(
+      duration=duration(temp))[1],
+  )
   if bgm_file == '':
-    shutil.copyfile(temp, output)
-    return output, '', kfa
+    # remux only, e.g. to fragment the video
+    output = await aconcat_copy(
+      [temp], output, mode=mode, with_previews=with_previews,
+      progress=telemetry.stage('audio_mix'),
+    )
   else:
-    return audio_mix(temp, bgm_file, output=output), bgm_file, kfa
+    # decoded and loudness normalized copy of the music
+    wav, gain = await asyncio.to_thread(
+      BGM.instance().prepare, bgm_file, telemetry.stage('bgm'),
+    )
+    output = await aaudio_mix(
+      temp, wav, output=output, bgm_volume=f'{gain}dB',
+      progress=telemetry.stage('audio_mix'), mode=mode,
+      with_previews=with_previews,
+    )
+
+  files = await encode_renditions(params, output, profile, telemetry)
+  return output, bgm_file, kfa, {
+    'encode': telemetry.stats,
+    'renditions': files,
+    'previews': previews,
+  }
+
+
+@activity.defn(name='render_video')
+async def render_video(params) -> tuple[str, str, list[str], dict]:
+  print('Rendering video...')
+
+  # single pass rendering, no intermediate video clips
+  telemetry = Telemetry()
+  profile = get_profile(params['profile'] if 'profile' in params else None)
+  output = os.path.join(params['cwd'], params['output'])
+  with_previews = params['previews'] if 'previews' in params else True
+  previews = preview_files(output) if with_previews else {}
+  mode = params['output_mode'] if 'output_mode' in params else 'mp4'
+  renditions = [get_rendition(r) for r in params.get('renditions', [])]
+
+  def pick():
+    # each clip is extended by 0.5s, see render()
+    total = sum([duration(a['audio']) + 0.5 for a in params['assets']])
+    _, bgm_file = BGM.instance(progress=telemetry.stage('bgm')).random(
+      duration=total)
+    if bgm_file == '':
+      return '', '', 0.0
+    return bgm_file, *BGM.instance().prepare(
+      bgm_file, progress=telemetry.stage('bgm'))
+
+  bgm_file, wav, gain = await asyncio.to_thread(pick)
+  output, kfa = await arender(
+    assets=params['assets'],
+    subtitles=params['subtitles'] if 'subtitles' in params else None,
+    size=params['size'] if 'size' in params else None,
+    bgm_file=wav,
+    bgm_volume=f'{gain}dB',
+    output=output,
+    profile=profile,
+    progress=telemetry.stage('render'),
+    seed=params['id'] if 'id' in params else None,
+    mode=mode,
+    with_previews=with_previews,
+    # split from the final frames, no decoding of the output again
+    renditions=renditions,
+  )
+
+  return output, bgm_file, kfa, {
+    'encode': telemetry.stats,
+    'renditions': rendition_files(
+      os.path.join(params['cwd'], params['output']), renditions, mode),
+    'previews': previews,
+  }
 
 
 if __name__ == '__main__':
   from workflow.base import run_activity
-  run_activity([generate_video, concat_video], task_queue='video-generation')
+  index_bgm()
+  run_activity([generate_video, concat_video, render_video],
+               task_queue='video-generation')
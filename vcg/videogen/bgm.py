@@ -1,15 +1,52 @@
 # path vcg/videogen/bgm.py
 
+import ffmpeg
+import json
+import logging
 import os
+import re
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from pathlib import Path
 
+from videogen.cache import FileCache, locked
+from videogen.scheduler import Scheduler
+
+
+# target integrated loudness(EBU R128) of background music in LUFS, close to
+# the former fixed -20dB on music mastered at about -16 LUFS
+bgm_loudness = float(os.getenv('VCG_BGM_LOUDNESS', default=-36.0))
+# music files of the library
+extensions = ('.m4a', '.mp3', '.wav')
+# a track fits a video if it is longer than the video, but not too long
+bgm_fit_ratio = 3.0
+# seconds the index is trusted without checking the library for changes
+bgm_index_ttl = float(os.getenv('VCG_BGM_INDEX_TTL', default=600.0))
+# size of the decoded copies in MB, about 60MB per 3 minutes of music
+bgm_cache_size = int(os.getenv('VCG_BGM_CACHE_SIZE', default=4096))
+
+
+def save_json(path, data):
+  """
+  Write json atomically, other workers may read the file at the same time.
+  """
+  temp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+  with open(temp, 'w') as fp:
+    json.dump(data, fp, ensure_ascii=False, indent=2)
+  os.replace(temp, path)
+
 
 class BGM:
   """
   A class that manages background music files.
   """
 
-  def __init__(self, path=None):
+  def __init__(self, path=None, cache=None, index=None, ttl=None,
+               progress=None):
     root = path if path is not None else os.getenv('VCG_BGM_ROOT')
     if root is None:
       raise RuntimeError(
@@ -17,11 +54,120 @@ class BGM:
     if not os.path.exists(root):
       raise RuntimeError(f'BGM root dir not exists: {root}')
     self._root = Path(root)
-    self._bgms = {os.path.basename(f): str(f) for f in [
-      *self._root.glob('**/*.m4a'),
-      *self._root.glob('**/*.mp3'),
-      *self._root.glob('**/*.wav'),
-    ]}
+    # decoded and loudness measured copies of the music files
+    self._cache = Path(cache or os.getenv(
+      'VCG_BGM_CACHE',
+      default=os.path.join(tempfile.gettempdir(), 'vcg-bgm'),
+    ))
+    self._prepared = FileCache(str(self._cache / 'prepared'),
+                               max_bytes=bgm_cache_size << 20)
+    # guards the index, music files are prepared under their own locks
+    self._lock = threading.Lock()
+
+    # persistent index of the library, one per root dir
+    digest = sha1(str(self._root.resolve()).encode('utf-8')).hexdigest()
+    self._index_file = Path(index or self._cache / f'index-{digest}.json')
+    self._ttl = bgm_index_ttl if ttl is None else ttl
+    self._index = self._load_index()
+    self._bgms = None
+    self.refresh(progress)
+
+  def refresh(self, progress=None):
+    """
+    Refresh the index if it is older than the ttl, see _refresh().
+    `progress` is called with the number of probed and new tracks, e.g.
+    to send heartbeats while a large library is indexed.
+    """
+    with self._lock:
+      fresh = time.time() - self._index.get('scanned', 0) < self._ttl
+      if fresh and self._bgms is not None:
+        return
+      if not fresh:
+        self._index = self._refresh(self._index, progress)
+      self._bgms = {os.path.basename(f): str(self._root / f)
+                    for f in sorted(self._index['tracks'])}
+
+  def _load_index(self) -> dict:
+    try:
+      with open(self._index_file, 'r') as fp:
+        index = json.load(fp)
+      if index.get('root') == str(self._root.resolve()):
+        return index
+    except (OSError, ValueError):
+      pass
+    return {'root': str(self._root.resolve()), 'dirs': {}, 'tracks': {}}
+
+  def _refresh(self, index, progress=None) -> dict:
+    """
+    Refresh the index incrementally, only the dirs modified since the last
+    scan are listed again, and only new or modified(size, mtime) music
+    files are probed. Every dir and track is stat'ed.
+    """
+    dirs = {}
+    files = []
+    stack = ['.']
+    while stack:
+      rel = stack.pop()
+      mtime = os.stat(self._root / rel).st_mtime_ns
+      entry = index['dirs'].get(rel)
+      if entry is None or entry['mtime_ns'] != mtime:
+        entries = list(os.scandir(self._root / rel))
+        entry = {
+          'mtime_ns': mtime,
+          'dirs': sorted(e.name for e in entries if e.is_dir()),
+          'files': sorted(e.name for e in entries if e.is_file() and
+                          e.name.lower().endswith(extensions)),
+        }
+      dirs[rel] = entry
+      stack.extend(os.path.normpath(os.path.join(rel, d))
+                   for d in entry['dirs'])
+      files.extend(os.path.normpath(os.path.join(rel, f))
+                   for f in entry['files'])
+
+    tracks = {}
+    new = []
+    for f in files:
+      stat = os.stat(self._root / f)
+      track = index['tracks'].get(f)
+      # files replaced or edited in place do not change the dir mtime
+      if track is not None and (track.get('size'), track.get('mtime_ns')) \
+         == (stat.st_size, stat.st_mtime_ns):
+        tracks[f] = track
+      else:
+        new.append((f, stat))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+      for i, (f, meta) in enumerate(executor.map(self._probe, new)):
+        tracks[f] = meta
+        if progress is not None:
+          progress({'probed': i + 1, 'total': len(new)})
+
+    refreshed = {'root': index['root'], 'scanned': time.time(),
+                 'dirs': dirs, 'tracks': tracks}
+    self._index_file.parent.mkdir(parents=True, exist_ok=True)
+    save_json(self._index_file, refreshed)
+    return refreshed
+
+  def _probe(self, args) -> tuple[str, dict]:
+    rel, stat = args
+    file = self._root / rel
+    meta = {'duration': None, 'sample_rate': None, 'codec': None,
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    try:
+      probe = ffmpeg.probe(str(file))
+    except ffmpeg.Error:
+      logging.warning(f'Failed to probe background music: {file}')
+      return rel, meta
+
+    astream = next((s for s in probe['streams']
+                    if s['codec_type'] == 'audio'), {})
+    duration = probe['format'].get('duration', astream.get('duration'))
+    meta.update({
+      'duration': float(duration) if duration is not None else None,
+      'sample_rate': int(astream.get('sample_rate', 0)) or None,
+      'codec': astream.get('codec_name'),
+    })
+    return rel, meta
 
   def __len__(self):
     return len(self._bgms)
@@ -35,17 +181,144 @@ class BGM:
   def all(self):
     return list(self._bgms.keys())
 
-  def random(self):
+  def _track(self, key) -> dict:
+    rel = os.path.relpath(self._bgms[key], self._root)
+    return self._index['tracks'][rel]
+
+  def meta(self, key) -> dict:
+    """
+    Metadata of the music: duration, sample_rate, codec, and loudness if
+    measured by prepare(). The loudness is kept with the decoded copy, not
+    in the index shared by the workers.
+    """
+    file = self._bgms[key]
+    data = self._prepared.read(self._key(file, os.stat(file)), '.json')
+    loudness = json.loads(data)['loudness'] if data is not None else None
+    return {**self._track(key), 'loudness': loudness}
+
+  def random(self, duration=None):
+    """
+    Pick a music file randomly, prefer the ones that fit the video if its
+    `duration`(seconds) is given, so the music is neither looped nor
+    decoded far past the end of the video.
+    """
     import random
     if len(self._bgms) == 0:
       return '', ''
-    key = random.choice(list(self._bgms.keys()))
+
+    keys = list(self._bgms.keys())
+    if duration is not None:
+      durations = {k: self._track(k)['duration'] or 0.0 for k in keys}
+      fits = [k for k in keys
+              if duration <= durations[k] <= duration * bgm_fit_ratio]
+      longer = [k for k in keys if durations[k] >= duration]
+      keys = fits or longer or keys
+
+    key = random.choice(keys)
     return key, self._bgms[key]
 
+  def prepare(self, file, progress=None) -> tuple[str, float]:
+    """
+    Get the ready-to-mix copy of the music file and its gain in dB.
+    The music is decoded once to a 44.1kHz stereo float WAV in the cache,
+    along with the gain to the target loudness `bgm_loudness`. A modified
+    music file gets a new entry, stale ones are evicted as the least
+    recently used, see FileCache.
+    `progress` is called while waiting for another worker decoding the
+    same file or for a ffmpeg slot, e.g. to send heartbeats.
+    """
+    key = self._key(file, os.stat(file))
+    on_wait = None
+    if progress is not None:
+      def on_wait(waited):
+        progress({'queued': round(waited, 1)})
+
+    # one decoding per music file on the host, others wait for it
+    with locked(str(self._cache / 'locks' / f'{key}.lock'), on_wait):
+      wav = self._prepared.lookup(key, '.wav')
+      data = self._prepared.read(key, '.json')
+      if wav is not None and data is not None:
+        info = json.loads(data)
+      else:
+        # decoded outside the cache dir, then linked in
+        temp = self._cache / \
+          f'{key}.{os.getpid()}.{threading.get_ident()}.wav'
+        try:
+          loudness = self._decode(file, temp, on_wait)
+          info = {
+            'file': os.path.abspath(file),
+            'loudness': loudness,
+            'gain': 0.0 if loudness is None else round(
+              bgm_loudness - loudness, 2),
+          }
+          self._prepared.write(key, json.dumps(info).encode('utf-8'),
+                               '.json', evict=False)
+          self._prepared.put(key, str(temp))
+        finally:
+          if temp.exists():
+            temp.unlink()
+        wav = self._prepared.lookup(key, '.wav')
+        logging.info(f'BGM prepared: {file}, {loudness} LUFS, '
+                     f'gain {info["gain"]}dB')
+
+    return wav, info['gain']
+
+  def _key(self, file, stat) -> str:
+    """
+    Cache key of the decoded copy of a version(size, mtime) of the music.
+    """
+    return sha1(f'{os.path.abspath(file)}:{stat.st_size}:'
+                f'{stat.st_mtime_ns}'.encode('utf-8')).hexdigest()
+
+  def prepare_all(self, workers=None) -> list[tuple[str, float]]:
+    """
+    Prepare all music files of the library, see prepare().
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      return list(executor.map(self.prepare, self._bgms.values()))
+
+  def _decode(self, file, output, on_wait=None) -> float | None:
+    """
+    Decode the music file to WAV, return its integrated loudness in LUFS,
+    or None if it is silent.
+    """
+    stream = ffmpeg.input(file).audio.filter(
+      # measure loudness while decoding, audio passes through unchanged
+      'ebur128',
+      framelog='quiet',
+    ).output(
+      str(output),
+      acodec='pcm_f32le',
+      ar=44100,
+      ac=2,
+      f='wav',
+    ).global_args('-hide_banner')
+
+    try:
+      with Scheduler.instance().slot(on_wait=on_wait):
+        _, stderr = ffmpeg.run(stream, quiet=True, overwrite_output=True)
+    except ffmpeg.Error as e:
+      logging.error(e.stderr.decode('utf-8'))
+      raise RuntimeError(f'Failed to prepare background music: {file}')
+
+    # summary of ebur128: "Integrated loudness: I: -14.3 LUFS ..."
+    matched = re.findall(r'I:\s+(-?[\d.]+|-inf) LUFS',
+                         stderr.decode('utf-8'))
+    if not matched or matched[-1] == '-inf':
+      return None
+    loudness = float(matched[-1])
+    # ebur128 reports -70 LUFS (the gate) for silence
+    return loudness if loudness > -70.0 else None
+
   _singleton = None
 
   @classmethod
-  def instance(cls):
+  def instance(cls, progress=None):
+    """
+    The shared instance, refreshed once its index expires, see refresh().
+    """
     if BGM._singleton is None:
-      BGM._singleton = BGM()
+      BGM._singleton = BGM(progress=progress)
+    else:
+      BGM._singleton.refresh(progress)
     return BGM._singleton
@@ -0,0 +1,208 @@
+# Path: videogen/cache.py
+
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1
+
+
+# digests of the least recently used files are dropped beyond this number
+max_digests = 4096
+_digests = OrderedDict()
+_digests_lock = threading.Lock()
+
+
+def file_digest(file) -> str:
+  """
+  sha1 of the file content, memoized by (path, size, mtime).
+  """
+  stat = os.stat(file)
+  key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+  with _digests_lock:
+    if key in _digests:
+      _digests.move_to_end(key)
+      return _digests[key]
+
+  s1 = sha1()
+  with open(file, 'rb') as fp:
+    while chunk := fp.read(1 << 20):
+      s1.update(chunk)
+  digest = s1.hexdigest()
+
+  with _digests_lock:
+    _digests[key] = digest
+    while len(_digests) > max_digests:
+      _digests.popitem(last=False)
+  return digest
+
+
+def link(src, dst):
+  """
+  Hardlink src to dst atomically, copy if they are on different devices.
+  dst is replaced if exists.
+  """
+  temp = f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+  try:
+    os.link(src, temp)
+  except OSError:
+    shutil.copyfile(src, temp)
+  os.replace(temp, dst)
+
+
+@contextmanager
+def locked(path, on_wait=None, interval=5.0, poll=0.1):
+  """
+  Hold an exclusive lock on the file `path` while in the context, shared
+  by all threads and workers of a host. `on_wait` is called with the
+  waiting time every `interval` seconds, e.g. to heartbeat while blocked.
+  """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+  try:
+    start = notified = time.monotonic()
+    while True:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except OSError:
+        now = time.monotonic()
+        if on_wait is not None and now - notified >= interval:
+          notified = now
+          on_wait(now - start)
+        time.sleep(poll)
+    yield
+  finally:
+    # closing the file releases the lock
+    os.close(fd)
+
+
+class FileCache:
+  """
+  A content-addressed cache of files in a directory, shared by all workers
+  of a host. Entries are hardlinked in and out of the cache, and the least
+  recently used ones are evicted when the cache grows over `max_bytes`.
+  """
+
+  def __init__(self, root, max_bytes=10 << 30):
+    self._root = root
+    self._max_bytes = max_bytes
+    os.makedirs(self._root, exist_ok=True)
+
+  def _path(self, key, ext=''):
+    # spread entries into sub dirs to keep dirs small
+    return os.path.join(self._root, key[:2], f'{key}{ext}')
+
+  def _touch(self, path):
+    # mark as recently used
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+
+  def get(self, key, dest) -> bool:
+    """
+    Link the cached file of `key` to `dest`, return False on cache miss.
+    """
+    path = self._path(key, os.path.splitext(dest)[1])
+    try:
+      link(path, dest)
+    except FileNotFoundError:
+      return False
+    self._touch(path)
+    return True
+
+  def put(self, key, src, evict=True):
+    """
+    Add the file to the cache as `key`, then evict if the cache is full.
+    """
+    path = self._path(key, os.path.splitext(src)[1])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    link(src, path)
+    if evict:
+      self.evict()
+
+  def lookup(self, key, ext='') -> str | None:
+    """
+    Path of the cached file of `key` in the cache, None on cache miss.
+    The entry is marked as recently used, so it is evicted last.
+    """
+    path = self._path(key, ext)
+    if not os.path.exists(path):
+      return None
+    self._touch(path)
+    return path
+
+  def read(self, key, ext='') -> bytes | None:
+    """
+    Read the cached data of `key`, return None on cache miss.
+    """
+    path = self._path(key, ext)
+    try:
+      with open(path, 'rb') as fp:
+        data = fp.read()
+    except FileNotFoundError:
+      return None
+    self._touch(path)
+    return data
+
+  def write(self, key, data: bytes, ext='', evict=True):
+    """
+    Add the data to the cache as `key`, then evict if the cache is full.
+    """
+    path = self._path(key, ext)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp, 'wb') as fp:
+      fp.write(data)
+    os.replace(temp, path)
+    if evict:
+      self.evict()
+
+  def entries(self) -> list[tuple[str, int, float]]:
+    """
+    Cache entries as (path, size, mtime), least recently used first.
+    """
+    entries = []
+    for dirpath, _, filenames in os.walk(self._root):
+      for name in filenames:
+        if name.endswith('.tmp') or name == '.lock':
+          continue
+        path = os.path.join(dirpath, name)
+        try:
+          stat = os.stat(path)
+        except FileNotFoundError:
+          continue
+        entries.append((path, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda e: e[2])
+
+  def size(self) -> int:
+    return sum([size for _, size, _ in self.entries()])
+
+  def evict(self):
+    """
+    Remove the least recently used entries until the cache fits.
+    """
+    with open(os.path.join(self._root, '.lock'), 'w') as fp:
+      # one worker evicts at a time
+      fcntl.flock(fp, fcntl.LOCK_EX)
+      entries = self.entries()
+      total = sum([size for _, size, _ in entries])
+      for path, size, _ in entries:
+        if total <= self._max_bytes:
+          break
+        try:
+          os.remove(path)
+          logging.info(f'Evicted from cache: {path}')
+        except FileNotFoundError:
+          pass
+        total -= size
+
+  @property
+  def root(self):
+    return self._root
@@ -1,18 +1,33 @@
 # Path: videogen/ffmpegcli.py
 
+import asyncio
 import ffmpeg
 import os
 import subprocess
 import logging
+import tempfile
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from ffmpeg.dag import topo_sort
+from ffmpeg.nodes import InputNode, OutputNode
+from hashlib import sha1
+
+from videogen.cache import FileCache, file_digest
+from videogen.image import normalize_all
 from videogen.keyframe import kfa
+from videogen.probe import Probe
+from videogen.profile import Profile, Rendition, get_profile
+from videogen.scheduler import Scheduler
+from videogen.subtitles import merge
 
 
 # shared ffmpeg command line parameters
 # https://ffmpeg.org/ffmpeg.html#Options
 # video: https://trac.ffmpeg.org/wiki/Encode/H.264
+# crf and preset are overridden by the render profile, see video_conf()
 vconf = {
-  'crf': 20,
   'tune': 'stillimage',
   'vcodec': 'libx264',
   'pix_fmt': 'yuvj420p',
@@ -28,191 +43,889 @@ oconf = {
   'strict': 'strict',
 }
 
-default_size = (720, 1280)
+# container of the final video, see output_conf()
+# mp4: progressive MP4 with the index(moov) at the front
+# fmp4: fragmented MP4, playable while being written
+# hls: HLS playlist(.m3u8) of fragmented MP4 segments, playable while being
+#  written
+output_modes = ('mp4', 'fmp4', 'hls')
+# target duration of fragments and HLS segments in seconds
+segment_time = 4
+
+# previews of the final video, see previews()
+# poster: a JPEG frame at `poster_time` seconds
+# sprite: a JPEG sheet of thumbnails evenly spaced over the video
+# preview: the first `preview_time` seconds in low fps, as WebP or GIF
+pconf = {
+  'poster_time': 1.0,
+  # columns x rows of thumbnails
+  'sprite_tile': (5, 2),
+  'sprite_width': 144,
+  'preview_time': 6,
+  'preview_fps': 8,
+  'preview_width': 240,
+  'preview_format': 'webp',
+}
+
+# number of video clips rendered concurrently by generate() and keyframe()
+default_workers = int(os.getenv(
+  'VCG_FFMPEG_WORKERS',
+  default=min(4, os.cpu_count() or 1),
+))
+
+# content-addressed cache of the clips rendered by generate() and keyframe(),
+# disabled unless VCG_RENDER_CACHE is set, see render_cache()
+# bump the version to invalidate cached clips when rendering changes
+cache_version = 1
+_render_cache = None
 
 
 def duration(file) -> float:
   """
   Get the duration of a video/audio file in seconds.
   """
-  probe = ffmpeg.probe(file)
-  return max([float(s['duration']) for s in probe['streams']
-              if s['duration'] is not None])
+  return Probe.instance().duration(file)
 
 
 def size(file) -> tuple[int, int]:
   """
   Get the resolution of a video file in pixels
   """
-  probe = ffmpeg.probe(file)
-  vstream = next((s for s in probe['streams']
-                 if s['codec_type'] == 'video'), None)
-  if vstream is None:
-    raise RuntimeError(f'ffprobe: No video stream found in {file}')
+  return Probe.instance().size(file)
+
+
+# alias for functions whose `size` argument shadows size()
+frame_size = size
+
+
+def video_conf(profile: Profile | None = None) -> dict:
+  """
+  Get video encoding parameters of the render profile.
+  """
+  profile = profile or get_profile()
+  return {**vconf, 'crf': profile.crf, 'preset': profile.preset}
+
+
+def output_file(output, mode='mp4') -> str:
+  """
+  Get the path of the final video written in `mode`.
+  HLS writes a playlist, named after `output` with extension `.m3u8`.
+  """
+  if mode not in output_modes:
+    raise ValueError(f'Unknown output mode: {mode}')
+  if mode == 'hls':
+    return f'{os.path.splitext(output)[0]}.m3u8'
+  return output
+
+
+def output_conf(output, mode='mp4', profile: Profile | None = None) -> dict:
+  """
+  Get muxer parameters of the final video written in `mode`.
+  If the video is encoded with `profile`, keyframes are inserted at least
+  every `segment_time` seconds in streaming modes, so fragments/segments
+  are short. Stream copied videos keep their keyframes.
+  """
+  base = os.path.splitext(output_file(output, mode))[0]
+  if mode == 'mp4':
+    # moov atom is moved to the front once the encoding is done
+    return {'movflags': '+faststart'}
+
+  conf = {}
+  if profile is not None:
+    conf['g'] = segment_time * profile.fps
+  if mode == 'fmp4':
+    return {
+      **conf,
+      'movflags': '+frag_keyframe+empty_moov+default_base_moof',
+    }
+  return {
+    **conf,
+    'f': 'hls',
+    'hls_time': segment_time,
+    # the playlist grows as segments are written, then ends
+    'hls_playlist_type': 'event',
+    'hls_flags': 'independent_segments',
+    'hls_segment_type': 'fmp4',
+    # written beside the segments
+    'hls_fmp4_init_filename': f'{os.path.basename(base)}_init.mp4',
+    'hls_segment_filename': f'{base}_%03d.m4s',
+  }
+
+
+def preview_files(output) -> dict[str, str]:
+  """
+  Get the paths of the previews of the final video, named after `output`.
+  """
+  base = os.path.splitext(output)[0]
+  return {
+    'poster': f'{base}_poster.jpg',
+    'sprite': f'{base}_sprite.jpg',
+    'preview': f'{base}_preview.{pconf["preview_format"]}',
+  }
 
-  return int(vstream['width']), int(vstream['height'])
+
+def previews(video, output, duration) -> list:
+  """
+  Create the outputs of the previews from the video stream, so they are
+  written by the command encoding the final video, without decoding it
+  again. `duration` is the duration of the video in seconds.
+  """
+  files = preview_files(output)
+  split = video.split()
+
+  poster = split[0].filter(
+    'select',
+    f'gte(t,{min(pconf["poster_time"], duration / 2):.3f})',
+  )
+
+  columns, rows = pconf['sprite_tile']
+  sprite = split[1].filter(
+    'fps',
+    fps=round(columns * rows / max(duration, 0.001), 4),
+  ).filter(
+    'scale',
+    w=pconf['sprite_width'],
+    h='-2',
+  ).filter(
+    'tile',
+    f'{columns}x{rows}',
+  )
+
+  preview = split[2].filter(
+    'trim',
+    duration=pconf['preview_time'],
+  ).filter(
+    'fps',
+    fps=pconf['preview_fps'],
+  ).filter(
+    'scale',
+    w=pconf['preview_width'],
+    h='-2',
+  )
+  if pconf['preview_format'] == 'gif':
+    # gif has 256 colors, generate the palette from the clip
+    frames = preview.split()
+    palette = frames[0].filter('palettegen', stats_mode='diff')
+    preview = ffmpeg.filter([frames[1], palette], 'paletteuse')
+    preview_conf = {'loop': 0}
+  else:
+    preview_conf = {'vcodec': 'libwebp', 'loop': 0, 'q:v': 60}
+
+  return [
+    ffmpeg.output(poster, files['poster'], vframes=1, **{'q:v': 2}),
+    ffmpeg.output(sprite, files['sprite'], vframes=1, **{'q:v': 3}),
+    ffmpeg.output(preview, files['preview'], **preview_conf),
+  ]
+
+
+def parse_progress(info: dict[str, str]) -> dict:
+  """
+  Parse a block of ffmpeg `-progress` output (key=value pairs).
+  """
+
+  def number(value, suffix=''):
+    try:
+      return float(value.strip().removesuffix(suffix))
+    except (AttributeError, ValueError):
+      return None
+
+  out_time = number(info.get('out_time_us'))
+  return {
+    'frame': int(number(info.get('frame')) or 0),
+    'fps': number(info.get('fps')),
+    'speed': number(info.get('speed'), 'x'),
+    'out_time': out_time / 1e6 if out_time is not None else None,
+    'bitrate': number(info.get('bitrate'), 'kbits/s'),
+    'done': info.get('progress') == 'end',
+  }
+
+
+def outputs(stream) -> list[str]:
+  """
+  Output files of a stream.
+  """
+  nodes, _ = topo_sort([stream.node])
+  return [str(node.kwargs['filename']) for node in nodes
+          if isinstance(node, OutputNode)]
 
 
-def run(stream, verbose=False):
+def render_cache() -> FileCache | None:
+  """
+  Get the render cache of VCG_RENDER_CACHE, sized by VCG_RENDER_CACHE_SIZE
+  in MB, None if disabled.
+  """
+  global _render_cache
+  root = os.getenv('VCG_RENDER_CACHE')
+  if not root:
+    return None
+  if _render_cache is None or _render_cache.root != root:
+    max_bytes = int(os.getenv('VCG_RENDER_CACHE_SIZE', default=10240)) << 20
+    _render_cache = FileCache(root, max_bytes=max_bytes)
+  return _render_cache
+
+
+def cache_key(stream, depends=()) -> str:
+  """
+  Hash of the ffmpeg command, with the input files and the files in
+  `depends`(e.g. subtitles) identified by their content instead of paths.
+  """
+  nodes, _ = topo_sort([stream.node])
+  files = {}
+  for node in nodes:
+    if isinstance(node, InputNode):
+      filename = str(node.kwargs['filename'])
+      if os.path.isfile(filename):
+        files[filename] = file_digest(filename)
+  for file in depends:
+    files[str(file)] = file_digest(file)
+  for filename in outputs(stream):
+    files[filename] = os.path.splitext(filename)[1]
+
+  s1 = sha1(f'vcg-render-v{cache_version}'.encode('utf-8'))
+  # longer paths first, in case a path is the prefix of another one
+  paths = sorted(files, key=len, reverse=True)
+  for arg in command(stream):
+    for path in paths:
+      arg = arg.replace(path, files[path])
+    s1.update(arg.encode('utf-8'))
+    s1.update(b'\0')
+  return s1.hexdigest()
+
+
+def _cached(stream, depends, progress):
+  """
+  Look up the output of the stream in the render cache, link it to the
+  output on hit. Return the cache key(None if disabled) and whether hit.
+  """
+  cache = render_cache()
+  if cache is None:
+    return None, False
+
+  key = cache_key(stream, depends)
+  output = outputs(stream)[0]
+  if cache.get(key, output):
+    logging.info(f'Render cache hit: {output}')
+    if progress is not None:
+      progress({'cached': True, 'done': True})
+    return key, True
+
+  # the output may be a hardlink of a cache entry, never write into it
+  if os.path.exists(output):
+    os.remove(output)
+  return key, False
+
+
+def _cache(key, stream):
+  if key is not None:
+    render_cache().put(key, outputs(stream)[0])
+
+
+def command(stream, threads=None, progress=False) -> list[str]:
+  """
+  Compile the ffmpeg command line of a stream.
+  Limit every encoder and the filter graph to `threads` if given.
+  """
+  args = [str(arg) for arg in stream.overwrite_output().compile()]
+  if threads is not None:
+    # -threads is an output option, insert it before each output file
+    for filename in outputs(stream):
+      i = len(args) - 1 - args[::-1].index(filename)
+      args[i:i] = ['-threads', str(threads)]
+    args = [
+      args[0],
+      '-filter_threads', str(threads),
+      '-filter_complex_threads', str(threads),
+      *args[1:],
+    ]
+  if progress:
+    # write progress as key=value pairs to stdout, periodically
+    args = [args[0], '-progress', 'pipe:1', '-nostats', *args[1:]]
+  return args
+
+
+def run(stream, verbose=False, progress=None):
   """
   Run a ffmpeg command with subprocess.
   Log error if return code is not 0, log stdout if verbose is True.
+  If `progress` is given, it is called with the parsed `-progress` output
+  (frame, fps, speed, out_time, bitrate) while ffmpeg is running.
+  The command waits for a slot of the host scheduler, see Scheduler.
   """
-  args = stream.overwrite_output().compile()
-  process = subprocess.Popen(
-    args,
-    stderr=subprocess.PIPE,
-    stdout=subprocess.PIPE,
-  )
-  stdout, stderr = process.communicate()
+
+  with Scheduler.instance().slot(on_wait=_on_wait(progress)) as threads:
+    args = command(stream, threads=threads, progress=progress is not None)
+    process = subprocess.Popen(
+      args,
+      stderr=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+    )
+    try:
+      if progress is None:
+        stdout, stderr = process.communicate()
+      else:
+        # drain stderr in background to avoid blocking ffmpeg
+        chunks = []
+        drain = threading.Thread(target=lambda: chunks.append(
+          process.stderr.read()))
+        drain.start()
+
+        reader = _progress_reader(progress)
+        for line in process.stdout:
+          reader(line)
+        process.wait()
+        drain.join()
+        stdout, stderr = b'', chunks[0] if chunks else b''
+    finally:
+      # e.g. the progress callback raised
+      if process.returncode is None:
+        process.kill()
+        process.wait()
+        logging.warning(f'ffmpeg killed: {args}')
+
+  return _returncode(args, process.returncode, stdout, stderr, verbose)
+
+
+async def arun(stream, verbose=False, progress=None):
+  """
+  Async version of run(), ffmpeg runs without blocking the event loop.
+  ffmpeg is killed if the task is cancelled.
+  """
+
+  async with Scheduler.instance().aslot(
+    on_wait=_on_wait(progress),
+  ) as threads:
+    args = command(stream, threads=threads, progress=progress is not None)
+    process = await asyncio.create_subprocess_exec(
+      *args,
+      stderr=asyncio.subprocess.PIPE,
+      stdout=asyncio.subprocess.PIPE,
+    )
+    try:
+      if progress is None:
+        stdout, stderr = await process.communicate()
+      else:
+        # drain stderr concurrently to avoid blocking ffmpeg
+        drain = asyncio.ensure_future(process.stderr.read())
+        reader = _progress_reader(progress)
+        async for line in process.stdout:
+          reader(line)
+        await process.wait()
+        stdout, stderr = b'', await drain
+    finally:
+      if process.returncode is None:
+        process.kill()
+        await process.wait()
+        logging.warning(f'ffmpeg killed: {args}')
+
+  return _returncode(args, process.returncode, stdout, stderr, verbose)
+
+
+def _on_wait(progress):
+  """
+  Report the waiting time for a scheduler slot as progress.
+  """
+  if progress is None:
+    return None
+
+  def on_wait(waited):
+    progress({'queued': round(waited, 1)})
+  return on_wait
+
+
+def _progress_reader(progress):
+  """
+  Line reader of the `-progress` output, call `progress` once per block.
+  """
+  info = {}
+
+  def read(line):
+    key, _, value = line.decode('utf-8').strip().partition('=')
+    info[key] = value
+    # `progress` is the last key of each block
+    if key == 'progress':
+      progress(parse_progress(info))
+      info.clear()
+  return read
+
+
+def _returncode(args, code, stdout, stderr, verbose):
   if verbose:
     logging.warning(stdout.decode('utf-8'))
-  if process.returncode != 0:
+  if code != 0:
     logging.error(args)
     logging.error(stderr.decode('utf-8'))
-  return process.returncode
+  return code
 
 
-def generate(assets, cwd, extend=0.5, verbose=False):
+def _tagged(progress, i):
   """
-  Generate videos from frames and audio.
-  assets = [
-    {'frames': [frame1, frame2, ...], 'audio': audio},
-    {'frames': [frame1, frame2, ...], 'audio': audio},
-    ...
-  ]
-  output = [
-    '1.mp4',
-    '2.mp4',
-     ...
-  ]
+  Tag progress info with the stream index `clip`.
   """
+  if progress is None:
+    return None
 
-  videos = []
-  for i, asset in enumerate(assets):
-    path = os.path.join(cwd, f'{i}.mp4')
+  def callback(info):
+    progress({**info, 'clip': i})
+  return callback
 
-    video = ffmpeg.input(
-      asset['frames'][0],
-      r=25,  # set fps explicitly to support gif
-      loop=1,
-      t=duration(asset['audio']) + extend,
-    ).video.filter(
-      'crop',
-      w='trunc(iw/2)*2',
-      h='trunc(ih/2)*2',
-    )
 
-    audio = ffmpeg.input(asset['audio']).audio.filter(
-      # extend(padding) audio by extend to make the concatenation more natural
-      'apad',
-      pad_dur=extend,
-    ).filter(
-      # convert audio to float format with sample rate 44.1kHz
-      'aformat',
-      sample_fmts='fltp',
-      sample_rates=44100,
+def run_all(streams, workers=None, verbose=False, progress=None,
+            cache=False, depends=None) -> list[int]:
+  """
+  Run ffmpeg commands concurrently with a bounded thread pool.
+  Return codes are returned in the same order as the streams.
+  Progress info passed to `progress` is tagged with the stream index `clip`.
+  If `cache` is True, outputs are looked up in the render cache first, and
+  `depends` are the extra files each stream depends on, see cache_key().
+  """
+  depends = depends or [[] for _ in streams]
+
+  def run_one(i, stream):
+    callback = _tagged(progress, i)
+    key, hit = None, False
+    if cache:
+      key, hit = _cached(stream, depends[i], callback)
+    if hit:
+      return 0
+    code = run(stream, verbose=verbose, progress=callback)
+    if code == 0:
+      _cache(key, stream)
+    return code
+
+  workers = max(1, min(workers or default_workers, len(streams) or 1))
+  if workers == 1:
+    return [run_one(i, stream) for i, stream in enumerate(streams)]
+
+  # ffmpeg does the heavy lifting in child processes, threads are enough
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(run_one, range(len(streams)), streams))
+
+
+async def arun_all(streams, workers=None, verbose=False, progress=None,
+                   cache=False, depends=None) -> list[int]:
+  """
+  Async version of run_all(), bounded by a semaphore instead of threads.
+  """
+  semaphore = asyncio.Semaphore(max(1, workers or default_workers))
+  depends = depends or [[] for _ in streams]
+
+  async def run_one(i, stream):
+    callback = _tagged(progress, i)
+    async with semaphore:
+      key, hit = None, False
+      if cache:
+        # hashing the inputs is blocking
+        key, hit = await asyncio.to_thread(
+          _cached, stream, depends[i], callback,
+        )
+      if hit:
+        return 0
+      code = await arun(stream, verbose=verbose, progress=callback)
+      if code == 0:
+        await asyncio.to_thread(_cache, key, stream)
+      return code
+
+  # cancelling the gathering task cancels(kills) all the commands
+  return list(await asyncio.gather(
+    *[run_one(i, stream) for i, stream in enumerate(streams)],
+  ))
+
+
+def clip(asset, extend=0.5, fps=25):
+  """
+  Create the video and audio streams of a single clip from its assets.
+  asset = {'frames': [frame1, frame2, ...], 'audio': audio}
+  """
+
+  video = ffmpeg.input(
+    asset['frames'][0],
+    r=fps,  # set fps explicitly to support gif
+    loop=1,
+    t=duration(asset['audio']) + extend,
+  ).video.filter(
+    'crop',
+    w='trunc(iw/2)*2',
+    h='trunc(ih/2)*2',
+  )
+
+  audio = ffmpeg.input(asset['audio']).audio.filter(
+    # extend(padding) audio by extend to make the concatenation more natural
+    'apad',
+    pad_dur=extend,
+  ).filter(
+    # convert audio to stereo float format with sample rate 44.1kHz
+    'aformat',
+    sample_fmts='fltp',
+    sample_rates=44100,
+    channel_layouts='stereo',
+  )
+
+  return video, audio
+
+
+def fit(video, width, height, contain=False):
+  """
+  Scale and pad the video stream to the given size.
+  The video is scaled to the width, or to fit inside the size if `contain`.
+  """
+  if contain:
+    video = video.filter(
+      'scale',
+      w=f'{width}',
+      h=f'{height}',
+      force_original_aspect_ratio='decrease',
+      force_divisible_by=2,
     )
+  else:
+    video = video.filter(
+      'scale',
+      w=f'{width}',
+      h='-2',
+    )
+  return video.filter(
+    'pad',
+    w=f'{width}',
+    h=f'{height}',
+    x='(ow-iw)/2',
+    y='(oh-ih)/2',
+    color='black',
+  ).filter(
+    'setsar',
+    r='1',
+    max='1'
+  )
+
+
+def _normalized(assets, canvas, cwd):
+  """
+  Assets with the rendered(first) frames normalized for the canvas, see
+  normalize().
+  """
+  frames = normalize_all([asset['frames'][0] for asset in assets], canvas, cwd)
+  return [{**asset, 'frames': [frame, *asset['frames'][1:]]}
+          for asset, frame in zip(assets, frames)]
+
+
+def _generate(assets, cwd, extend, profile, size):
+  """
+  Build the ffmpeg commands of generate(), return [(path, stream), ...].
+  """
+  assets = _normalized(assets, size or profile.size, cwd)
+  jobs = []
+  for i, asset in enumerate(assets):
+    path = os.path.join(cwd, f'{i}.mp4')
+    video, audio = clip(asset, extend=extend, fps=profile.fps)
 
     stream = ffmpeg.concat(
       video, audio,
       v=1, a=1, n=2,
     ).output(
       path,
-      **vconf, **aconf, **oconf,
+      **video_conf(profile), **aconf, **oconf,
       shortest=None,
     )
+    jobs.append((path, stream))
+  return jobs
 
-    if run(stream, verbose=verbose) == 0:
+
+def _generated(jobs, codes) -> list[str]:
+  videos = []
+  for (path, _), code in zip(jobs, codes):
+    if code == 0:
       logging.info(f'Video clip: {path}')
       videos.append(path)
-
   return videos
 
 
-def keyframe(videos, cwd, verbose=False):
+def generate(assets, cwd, extend=0.5, workers=None, profile=None,
+             verbose=False, progress=None, size=None):
   """
-  Add keyframe animation to videos
-  videos = [
-    '1.mp4',
-    '2.mp4',
+  Generate videos from frames and audio, `workers` clips at a time.
+  Frames are normalized for the output `size` first, see normalize().
+  assets = [
+    {'frames': [frame1, frame2, ...], 'audio': audio},
+    {'frames': [frame1, frame2, ...], 'audio': audio},
     ...
   ]
   output = [
-    '1_kfa.mp4',
-    '2_kfa.mp4',
-    ...
+    '1.mp4',
+    '2.mp4',
+     ...
   ]
   """
 
-  kfa_names = []
-  kfa_videos = []
-  for src in videos:
+  profile = profile or get_profile()
+  jobs = _generate(assets, cwd, extend, profile, size)
+  codes = run_all([stream for _, stream in jobs], workers,
+                  verbose=verbose, progress=progress, cache=True)
+  return _generated(jobs, codes)
+
+
+async def agenerate(assets, cwd, extend=0.5, workers=None, profile=None,
+                    verbose=False, progress=None, size=None):
+  """
+  Async version of generate().
+  """
+
+  profile = profile or get_profile()
+  # probing is blocking, build the commands in a thread
+  jobs = await asyncio.to_thread(
+    _generate, assets, cwd, extend, profile, size,
+  )
+  codes = await arun_all([stream for _, stream in jobs], workers,
+                         verbose=verbose, progress=progress, cache=True)
+  return _generated(jobs, codes)
+
+
+def _keyframe(videos, cwd, subtitles, size, profile, seed):
+  """
+  Build the ffmpeg commands of keyframe(),
+  return [((src, output, size, effect name), stream), ...].
+  """
+  if subtitles is not None and size is None:
+    raise ValueError('Subtitles can only be burned with the output size')
+  if subtitles is not None and len(videos) != len(subtitles):
+    raise ValueError('The number of videos and subtitles must be the same')
+
+  jobs = []
+  for i, src in enumerate(videos):
     input = ffmpeg.input(src)
     output = os.path.join(cwd, f'{os.path.basename(src)}_kfa.mp4')
 
-    s = size(src)
-    video, name = kfa(input.video, size=s, duration=duration(src))
+    s = frame_size(src)
+    video, name = kfa(
+      input.video, size=s, duration=duration(src),
+      fps=profile.fps, scale=profile.kfa_scale, engine=profile.kfa_engine,
+      seed=None if seed is None else f'{seed}:{i}',
+    )
+    if size is not None:
+      video = fit(video, *size)
+      if subtitles is not None:
+        video = burn(video, [subtitles[i]], [duration(src)], size, output)
     stream = ffmpeg.output(
       video, input.audio,
-      output, **vconf, **aconf, **oconf,
+      output, **video_conf(profile), **aconf, **oconf,
     )
+    jobs.append(((src, output, s, name), stream))
+  return jobs
+
+
+def _depends(videos, subtitles):
+  # subtitles are referred by the filter graph, not as inputs
+  if subtitles is None:
+    return [[] for _ in videos]
+  return [[subtitle] for subtitle in subtitles]
 
-    if run(stream, verbose=verbose) == 0:
+
+def _keyframed(jobs, codes) -> tuple[list[str], list[str]]:
+  kfa_names = []
+  kfa_videos = []
+  for ((src, output, s, name), _), code in zip(jobs, codes):
+    if code == 0:
       logging.info(f'Add keyframe animation {name} to video{s}: {src}')
       kfa_videos.append(output)
       kfa_names.append(name)
-
   return kfa_videos, kfa_names
 
 
-def concat(videos, output, subtitles=None, size=None, verbose=False):
+def keyframe(videos, cwd, subtitles=None, size=None, workers=None,
+             profile=None, verbose=False, progress=None, seed=None):
   """
-  Concatenate videos.
-  Scale and pad the videos to the same size, then concatenate them.
+  Add keyframe animation to videos.
+  If `size` is given, scale and pad the videos to it and burn `subtitles`
+  (rescaled to `size`) in the same pass, which encodes anyway, so the
+  outputs can be joined by concat() without re-encoding.
+  videos = [
+    '1.mp4',
+    '2.mp4',
+    ...
+  ]
+  output = [
+    '1_kfa.mp4',
+    '2_kfa.mp4',
+    ...
+  ]
+  The same `seed` picks the same animations, see kfa().
   """
 
-  width, height = size or default_size
+  profile = profile or get_profile()
+  jobs = _keyframe(videos, cwd, subtitles, size, profile, seed)
+  codes = run_all([stream for _, stream in jobs], workers,
+                  verbose=verbose, progress=progress, cache=True,
+                  depends=_depends(videos, subtitles))
+  return _keyframed(jobs, codes)
 
-  if subtitles is not None and len(videos) != len(subtitles):
-    raise ValueError('The number of videos and subtitles must be the same')
+
+async def akeyframe(videos, cwd, subtitles=None, size=None, workers=None,
+                    profile=None, verbose=False, progress=None, seed=None):
+  """
+  Async version of keyframe().
+  """
+
+  profile = profile or get_profile()
+  jobs = await asyncio.to_thread(
+    _keyframe, videos, cwd, subtitles, size, profile, seed,
+  )
+  codes = await arun_all([stream for _, stream in jobs], workers,
+                         verbose=verbose, progress=progress, cache=True,
+                         depends=_depends(videos, subtitles))
+  return _keyframed(jobs, codes)
+
+
+def uniform(videos, size) -> bool:
+  """
+  Check if the videos share codec, resolution(of `size`), SAR and audio
+  format, so they can be concatenated without re-encoding.
+  """
+  vkeys = ['codec_name', 'profile', 'width', 'height', 'pix_fmt',
+           'sample_aspect_ratio', 'r_frame_rate', 'time_base']
+  akeys = ['codec_name', 'sample_rate', 'channels']
+
+  signatures = set()
+  for file in videos:
+    streams = Probe.instance().probe(file)['streams']
+    vstreams = [s for s in streams if s['codec_type'] == 'video']
+    astreams = [s for s in streams if s['codec_type'] == 'audio']
+    if len(vstreams) != 1 or len(astreams) != 1:
+      return False
+    v, a = vstreams[0], astreams[0]
+    if (int(v['width']), int(v['height'])) != tuple(size):
+      return False
+    if v.get('sample_aspect_ratio', '1:1') not in ('1:1', '0:1'):
+      return False
+    signatures.add((
+      tuple(v.get(k) for k in vkeys),
+      tuple(a.get(k) for k in akeys),
+    ))
+
+  return len(signatures) == 1
+
+
+def burn(video, subtitles, durations, size, output):
+  """
+  Burn subtitles of the clips on the concatenated video stream at once.
+  The subtitles are merged into a single timeline of the output `size`,
+  and saved beside `output` as an ASS file.
+  """
+  path = f'{os.path.splitext(output)[0]}.ass'
+  merge(subtitles, durations, size).save(path)
+  return video.filter(
+    'subtitles',
+    f=path,
+  )
+
+
+def _playlist(videos, output):
+  """
+  Write the playlist of the concat demuxer beside the output.
+  """
+  with tempfile.NamedTemporaryFile(
+    'w', suffix='.txt', dir=os.path.dirname(os.path.abspath(output)),
+    delete=False,
+  ) as fp:
+    for file in videos:
+      path = os.path.abspath(file).replace("'", "'\\''")
+      fp.write(f"file '{path}'\n")
+    return fp.name
+
+
+def _concat_copy(playlist, output, mode, preview_duration=None):
+  """
+  Build the ffmpeg command of concat_copy(), with the previews if the
+  duration of the previews is given.
+  """
+  input = ffmpeg.input(playlist, f='concat', safe=0)
+  stream = ffmpeg.output(
+    input.video, input.audio,
+    output_file(output, mode), c='copy', **oconf,
+    **output_conf(output, mode),
+  )
+  if preview_duration is None:
+    return stream
+  return ffmpeg.merge_outputs(
+    stream, *previews(input.video, output, preview_duration),
+  )
+
+
+def _concat_copied(code, output):
+  if code != 0:
+    raise RuntimeError(f'Failed to concatenate videos: {output}')
+
+  logging.info(f'Video clips concatenated(stream copy): {output}')
+
+  return output
+
+
+def concat_copy(videos, output, verbose=False, progress=None, mode='mp4',
+                with_previews=False):
+  """
+  Concatenate videos with the concat demuxer, without re-encoding.
+  All videos must share the same codecs and parameters, see uniform().
+  Return the path of the output written in `mode`, see output_file().
+  If `with_previews`, the previews are written too, see previews().
+  """
+
+  d = sum([duration(f) for f in videos]) if with_previews else None
+  playlist = _playlist(videos, output)
+  try:
+    code = run(_concat_copy(playlist, output, mode, d), verbose=verbose,
+               progress=progress)
+  finally:
+    os.remove(playlist)
+
+  return _concat_copied(code, output_file(output, mode))
+
+
+async def aconcat_copy(videos, output, verbose=False, progress=None,
+                       mode='mp4', with_previews=False):
+  """
+  Async version of concat_copy().
+  """
+
+  d = None
+  if with_previews:
+    d = await asyncio.to_thread(lambda: sum([duration(f) for f in videos]))
+  playlist = _playlist(videos, output)
+  try:
+    code = await arun(_concat_copy(playlist, output, mode, d),
+                      verbose=verbose, progress=progress)
+  finally:
+    os.remove(playlist)
+
+  return _concat_copied(code, output_file(output, mode))
+
+
+def _concat(videos, output, subtitles, size, profile, mode):
+  """
+  Build the ffmpeg command of concat() with the concat filter.
+  """
+  width, height = size
 
   filter_graphs = []
-  for i, file in enumerate(videos):
+  for file in videos:
     input = ffmpeg.input(file)
-    video = input.video.filter(
-      'scale',
-      w=f'{width}',
-      h='-2',
-    ).filter(
-      'pad',
-      w=f'{width}',
-      h=f'{height}',
-      x='(ow-iw)/2',
-      y='(oh-ih)/2',
-      color='black',
-    ).filter(
-      'setsar',
-      r='1',
-      max='1'
-    )
-    if subtitles is not None:
-      video = video.filter(
-        'subtitles',
-        f=subtitles[i],
-      )
-    filter_graphs.append(video)
+    filter_graphs.append(fit(input.video, width, height))
     filter_graphs.append(input.audio)
 
   try:
-    stream = ffmpeg.concat(*filter_graphs, v=1, a=1).output(
-      output, **vconf, **aconf, **oconf,
+    joined = ffmpeg.concat(*filter_graphs, v=1, a=1).node
+    video, audio = joined[0], joined[1]
+    if subtitles is not None:
+      # a segment lasts as long as its longest stream
+      video = burn(video, subtitles, [duration(f) for f in videos],
+                   (width, height), output)
+    return ffmpeg.output(
+      video, audio,
+      output_file(output, mode), **video_conf(profile), **aconf, **oconf,
+      **output_conf(output, mode, profile),
     )
   except Exception as e:
     logging.error(str(e))
     raise RuntimeError(f'Failed to assemble stream: {output}')
 
-  if run(stream, verbose=verbose) != 0:
+
+def _concatenated(code, output):
+  if code != 0:
     raise RuntimeError(f'Failed to concatenate videos: {output}')
 
   logging.info(f'Video clips concatenated: {output}')
@@ -220,12 +933,61 @@ def concat(videos, output, subtitles=None, size=None, verbose=False):
   return output
 
 
-def audio_mix(video_file, bgm_file, output,
-              verbose=False, bgm_volume='-20dB'):
+def concat(videos, output, subtitles=None, size=None, profile=None,
+           verbose=False, progress=None, mode='mp4'):
   """
-  Add background music to video.
+  Concatenate videos.
+  Scale and pad the videos to the same size, then concatenate them.
+  Subtitles of the videos are merged and burned once on the joined video.
+  Join them by stream copy if they are already uniform, see uniform(), and
+  have no subtitles to burn, e.g. burned by keyframe().
+  Return the path of the output written in `mode`, see output_file().
   """
 
+  profile = profile or get_profile()
+  size = size or profile.size
+
+  if subtitles is not None and len(videos) != len(subtitles):
+    raise ValueError('The number of videos and subtitles must be the same')
+
+  # join by stream copy if padding and subtitles were applied upstream
+  if subtitles is None and uniform(videos, size):
+    return concat_copy(videos, output, verbose=verbose, progress=progress,
+                       mode=mode)
+
+  stream = _concat(videos, output, subtitles, size, profile, mode)
+  code = run(stream, verbose=verbose, progress=progress)
+  return _concatenated(code, output_file(output, mode))
+
+
+async def aconcat(videos, output, subtitles=None, size=None, profile=None,
+                  verbose=False, progress=None, mode='mp4'):
+  """
+  Async version of concat().
+  """
+
+  profile = profile or get_profile()
+  size = size or profile.size
+
+  if subtitles is not None and len(videos) != len(subtitles):
+    raise ValueError('The number of videos and subtitles must be the same')
+
+  if subtitles is None and await asyncio.to_thread(uniform, videos, size):
+    return await aconcat_copy(videos, output, verbose=verbose,
+                              progress=progress, mode=mode)
+
+  stream = await asyncio.to_thread(
+    _concat, videos, output, subtitles, size, profile, mode,
+  )
+  code = await arun(stream, verbose=verbose, progress=progress)
+  return _concatenated(code, output_file(output, mode))
+
+
+def _audio_mix(video_file, bgm_file, output, bgm_volume, mode,
+               with_previews):
+  """
+  Build the ffmpeg command of audio_mix().
+  """
   input = ffmpeg.input(video_file)
 
   bgm = ffmpeg.input(
@@ -236,26 +998,327 @@ def audio_mix(video_file, bgm_file, output,
     volume=bgm_volume,
   )
 
-  # Merge audio streams
+  # Merge audio streams, amerge ends with the shortest input(the voice)
   merged_audio = ffmpeg.filter(
     (input.audio, bgm),
     'amerge',
     inputs=2,
   )
-  stream = ffmpeg.concat(
-    input.video,
-    merged_audio,
-    v=1, a=1, n=2,
-  ).output(
-    output,
-    # can not use vcodec='copy' here
-    # FFmpeg: Filtering and streamcopy cannot be used together
-    **vconf, **aconf, **oconf
+  stream = ffmpeg.output(
+    # streams out of the filter graph can be copied without decoding
+    input.video, merged_audio,
+    output_file(output, mode),
+    vcodec='copy', **aconf, **oconf, **output_conf(output, mode),
   )
+  if not with_previews:
+    return stream
+  # the video is decoded only for the previews
+  return ffmpeg.merge_outputs(
+    stream, *previews(input.video, output, duration(video_file)),
+  )
+
 
-  if run(stream, verbose=verbose) != 0:
+def _audio_mixed(code, video_file, output):
+  if code != 0:
     raise RuntimeError(f'Failed to add background music to {video_file}')
 
   logging.info(f'Background music mixed: {output}')
 
   return output
+
+
+def audio_mix(video_file, bgm_file, output, verbose=False,
+              bgm_volume='-20dB', progress=None, mode='mp4',
+              with_previews=False):
+  """
+  Add background music to video.
+  Only the audio is filtered and encoded, the video stream is copied.
+  Return the path of the output written in `mode`, see output_file().
+  If `with_previews`, the previews are written too, see previews().
+  """
+
+  stream = _audio_mix(video_file, bgm_file, output, bgm_volume, mode,
+                      with_previews)
+  code = run(stream, verbose=verbose, progress=progress)
+  return _audio_mixed(code, video_file, output_file(output, mode))
+
+
+async def aaudio_mix(video_file, bgm_file, output, verbose=False,
+                     bgm_volume='-20dB', progress=None, mode='mp4',
+                     with_previews=False):
+  """
+  Async version of audio_mix().
+  """
+
+  stream = await asyncio.to_thread(
+    _audio_mix, video_file, bgm_file, output, bgm_volume, mode,
+    with_previews,
+  )
+  code = await arun(stream, verbose=verbose, progress=progress)
+  return _audio_mixed(code, video_file, output_file(output, mode))
+
+
+def rendition_file(output, rendition: Rendition) -> str:
+  """
+  Get the path of a rendition of the final video, named after `output`.
+  """
+  base, ext = os.path.splitext(output)
+  return f'{base}_{rendition.name}{ext}'
+
+
+def rendition_profile(rendition: Rendition, profile: Profile) -> Profile:
+  """
+  Get the render profile of a rendition, based on `profile`.
+  """
+  return replace(
+    profile,
+    size=tuple(rendition.size),
+    crf=rendition.crf if rendition.crf is not None else profile.crf,
+    fps=rendition.fps if rendition.fps is not None else profile.fps,
+  )
+
+
+def rendition_conf(rendition: Rendition, profile: Profile) -> dict:
+  """
+  Get video encoding parameters of a rendition.
+  """
+  conf = video_conf(rendition_profile(rendition, profile))
+  if rendition.bitrate is not None:
+    # capped average bitrate instead of constant quality
+    del conf['crf']
+    conf.update({
+      'video_bitrate': rendition.bitrate,
+      'maxrate': rendition.bitrate,
+      'bufsize': rendition.bitrate,
+    })
+  return conf
+
+
+def rendition_files(output, renditions, mode='mp4') -> list[str]:
+  """
+  Get the paths of the renditions of `output` written in `mode`.
+  """
+  return [output_file(rendition_file(output, rendition), mode)
+          for rendition in renditions]
+
+
+def rendition_outputs(videos, audios, output, renditions, profile, mode,
+                      audio_conf) -> list:
+  """
+  Output streams of the renditions, scaled from the (split) video streams
+  `videos`, with the audio streams `audios` encoded by `audio_conf`, one of
+  each per rendition.
+  """
+  streams = []
+  for video, audio, rendition in zip(videos, audios, renditions):
+    if rendition.fps is not None:
+      video = video.filter('fps', fps=rendition.fps)
+    video = fit(video, *rendition.size, contain=True)
+
+    path = rendition_file(output, rendition)
+    streams.append(ffmpeg.output(
+      video, audio,
+      output_file(path, mode),
+      **rendition_conf(rendition, profile), **audio_conf, **oconf,
+      **output_conf(path, mode, rendition_profile(rendition, profile)),
+    ))
+  return streams
+
+
+def _ladder(video_file, output, renditions, profile, mode):
+  """
+  Build the ffmpeg command of ladder(), return (stream, [path, ...]).
+  """
+  if len(renditions) == 0:
+    raise ValueError('No rendition to encode')
+
+  input = ffmpeg.input(video_file)
+  # decode once, every rendition is scaled from the same frames
+  split = input.video.split()
+  streams = rendition_outputs(
+    [split[i] for i in range(len(renditions))],
+    # the audio is shared, copy it without re-encoding
+    [input.audio] * len(renditions),
+    output, renditions, profile, mode, {'acodec': 'copy'},
+  )
+  return (ffmpeg.merge_outputs(*streams),
+          rendition_files(output, renditions, mode))
+
+
+def _laddered(code, video_file, files):
+  if code != 0:
+    raise RuntimeError(f'Failed to encode renditions of {video_file}')
+
+  for file in files:
+    logging.info(f'Video rendition: {file}')
+
+  return files
+
+
+def ladder(video_file, output, renditions, profile=None, verbose=False,
+           progress=None, mode='mp4'):
+  """
+  Encode renditions (size, quality, fps) of the final video in one ffmpeg
+  pass, the video is decoded once and split to all the renditions.
+  Renditions are named after `output`, see rendition_file().
+  renditions = [
+    Rendition(size=(360, 640), bitrate='800k', fps=15),
+    ...
+  ]
+  output = [
+    'output_360x640_800k.mp4',
+    ...
+  ]
+  """
+
+  profile = profile or get_profile()
+  stream, files = _ladder(video_file, output, renditions, profile, mode)
+  code = run(stream, verbose=verbose, progress=progress)
+  return _laddered(code, video_file, files)
+
+
+async def aladder(video_file, output, renditions, profile=None,
+                  verbose=False, progress=None, mode='mp4'):
+  """
+  Async version of ladder().
+  """
+
+  profile = profile or get_profile()
+  stream, files = _ladder(video_file, output, renditions, profile, mode)
+  code = await arun(stream, verbose=verbose, progress=progress)
+  return _laddered(code, video_file, files)
+
+
+def _render(assets, output, subtitles, size, bgm_file, extend, profile,
+            bgm_volume, seed, mode, with_previews, renditions):
+  """
+  Build the ffmpeg command of render(), return (stream, kfa_names).
+  """
+  width, height = size or profile.size
+
+  if subtitles is not None and len(assets) != len(subtitles):
+    raise ValueError('The number of assets and subtitles must be the same')
+
+  assets = _normalized(assets, (width, height),
+                       os.path.dirname(os.path.abspath(output)))
+  kfa_names = []
+  durations = []
+  filter_graphs = []
+  for i, asset in enumerate(assets):
+    video, audio = clip(asset, extend=extend, fps=profile.fps)
+    d = duration(asset['audio']) + extend
+
+    # keyframe animation works on the cropped(even) size of the image
+    w, h = frame_size(asset['frames'][0])
+    s = (w // 2 * 2, h // 2 * 2)
+    video, name = kfa(
+      video, size=s, duration=d,
+      fps=profile.fps, scale=profile.kfa_scale, engine=profile.kfa_engine,
+      seed=None if seed is None else f'{seed}:{i}',
+    )
+    kfa_names.append(name)
+    durations.append(d)
+
+    filter_graphs.append(fit(video, width, height))
+    filter_graphs.append(audio)
+
+  try:
+    joined = ffmpeg.concat(*filter_graphs, v=1, a=1).node
+    video, audio = joined[0], joined[1]
+    if subtitles is not None:
+      video = burn(video, subtitles, durations, (width, height), output)
+    if bgm_file is not None and bgm_file != '':
+      bgm = ffmpeg.input(
+        bgm_file,
+        stream_loop=-1,
+      ).filter(
+        'volume',
+        volume=bgm_volume,
+      )
+      audio = ffmpeg.filter(
+        (audio, bgm),
+        'amerge',
+        inputs=2,
+      )
+    extra = []
+    renditions = renditions or []
+    if with_previews or renditions:
+      split = video.split()
+      video = split[0]
+      if with_previews:
+        extra = previews(split[1], output, sum(durations))
+      if renditions:
+        # encoded from the same frames as the output, not from the output
+        first = 2 if with_previews else 1
+        asplit = audio.asplit()
+        audio = asplit[0]
+        extra += rendition_outputs(
+          [split[first + i] for i in range(len(renditions))],
+          [asplit[1 + i] for i in range(len(renditions))],
+          output, renditions, profile, mode, aconf,
+        )
+    stream = ffmpeg.output(
+      video, audio,
+      output_file(output, mode), **video_conf(profile), **aconf, **oconf,
+      **output_conf(output, mode, profile),
+    )
+    if extra:
+      stream = ffmpeg.merge_outputs(stream, *extra)
+  except Exception as e:
+    logging.error(str(e))
+    raise RuntimeError(f'Failed to assemble stream: {output}')
+
+  return stream, kfa_names
+
+
+def _rendered(code, output):
+  if code != 0:
+    raise RuntimeError(f'Failed to render video: {output}')
+
+  logging.info(f'Video rendered: {output}')
+
+  return output
+
+
+def render(assets, output, subtitles=None, size=None, bgm_file=None,
+           extend=0.5, profile=None, verbose=False, bgm_volume='-20dB',
+           progress=None, seed=None, mode='mp4', with_previews=False,
+           renditions=None):
+  """
+  Render the final video from frames and audio in a single ffmpeg pass.
+  Fuse generate, keyframe, concat and audio_mix into one filter graph, so
+  the output is encoded exactly once and no intermediate file is written.
+  assets = [
+    {'frames': [frame1, frame2, ...], 'audio': audio},
+    ...
+  ]
+  output = ('output.mp4', ['zoom_in', 'pan_left', ...])
+  The output is written in `mode`, see output_file().
+  If `with_previews`, the previews are written too, see previews().
+  `renditions` are encoded in the same pass, split from the final video
+  stream, see ladder() and rendition_files().
+  """
+
+  profile = profile or get_profile()
+  stream, kfa_names = _render(assets, output, subtitles, size, bgm_file,
+                              extend, profile, bgm_volume, seed, mode,
+                              with_previews, renditions)
+  code = run(stream, verbose=verbose, progress=progress)
+  return _rendered(code, output_file(output, mode)), kfa_names
+
+
+async def arender(assets, output, subtitles=None, size=None, bgm_file=None,
+                  extend=0.5, profile=None, verbose=False,
+                  bgm_volume='-20dB', progress=None, seed=None,
+                  mode='mp4', with_previews=False, renditions=None):
+  """
+  Async version of render().
+  """
+
+  profile = profile or get_profile()
+  stream, kfa_names = await asyncio.to_thread(
+    _render, assets, output, subtitles, size, bgm_file, extend, profile,
+    bgm_volume, seed, mode, with_previews, renditions,
+  )
+  code = await arun(stream, verbose=verbose, progress=progress)
+  return _rendered(code, output_file(output, mode)), kfa_names
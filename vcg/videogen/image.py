@@ -0,0 +1,119 @@
+# Path: videogen/image.py
+
+import logging
+import math
+import os
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from PIL import Image, ImageOps
+
+from videogen.cache import FileCache, file_digest
+
+
+# images are scaled to the canvas width by fit(), with headroom for the max
+# zoom of keyframe animations, see kfa()
+headroom = 1.5
+# bump the version to invalidate normalized images when normalization changes
+image_version = 1
+# EXIF orientation tag
+orientation_tag = 0x0112
+
+_image_cache = None
+
+
+def image_cache() -> FileCache:
+  """
+  Get the cache of normalized images of VCG_IMAGE_CACHE, sized by
+  VCG_IMAGE_CACHE_SIZE in MB.
+  """
+  global _image_cache
+  root = os.getenv(
+    'VCG_IMAGE_CACHE',
+    default=os.path.join(tempfile.gettempdir(), 'vcg-image'),
+  )
+  if _image_cache is None or _image_cache.root != root:
+    max_bytes = int(os.getenv('VCG_IMAGE_CACHE_SIZE', default=2048)) << 20
+    _image_cache = FileCache(root, max_bytes=max_bytes)
+  return _image_cache
+
+
+def target_size(size, canvas, headroom=headroom) -> tuple[int, int]:
+  """
+  Get the size of an image normalized for the canvas(width, height).
+  Images are only downscaled, to `headroom` times of the canvas width.
+  """
+  width, height = size
+  max_width = math.ceil(canvas[0] * headroom / 2) * 2
+  if width <= max_width:
+    return width, height
+  return max_width, max(1, round(height * max_width / width))
+
+
+def _has_alpha(image) -> bool:
+  return image.mode in ('RGBA', 'LA', 'PA') or (
+    image.mode == 'P' and 'transparency' in image.info)
+
+
+def normalize(file, canvas, cwd) -> str:
+  """
+  Normalize an image for the canvas(width, height) of the video:
+  apply the EXIF orientation and downscale it to the target size, see
+  target_size(), so ffmpeg does not scale huge frames over and over.
+  The normalized image is written to `cwd` and cached, the original file
+  is returned if it is already normalized, or animated(e.g. gif).
+  """
+  with Image.open(file) as image:
+    if getattr(image, 'is_animated', False):
+      return str(file)
+
+    orientation = image.getexif().get(orientation_tag, 1)
+    # orientations 5-8 swap width and height
+    rotated = orientation in (5, 6, 7, 8)
+    size = image.size[::-1] if rotated else image.size
+    target = target_size(size, canvas)
+    if target == size and orientation == 1:
+      return str(file)
+
+    ext = '.png' if _has_alpha(image) else '.jpg'
+    key = sha1(
+      f'vcg-image-v{image_version}:{file_digest(file)}:'
+      f'{target[0]}x{target[1]}'.encode('utf-8')
+    ).hexdigest()
+    output = os.path.join(cwd, f'{key}{ext}')
+    if os.path.exists(output) or image_cache().get(key, output):
+      return output
+
+    if image.format == 'JPEG':
+      # decode at a reduced scale (DCT scaling), no smaller than the target
+      image.draft('RGB', target[::-1] if rotated else target)
+    normalized = ImageOps.exif_transpose(image)
+    if normalized.size != target:
+      normalized = normalized.resize(target, Image.Resampling.LANCZOS)
+
+    temp = f'{output}.{os.getpid()}.tmp'
+    if ext == '.png':
+      normalized.convert('RGBA').save(temp, format='PNG')
+    else:
+      normalized.convert('RGB').save(temp, format='JPEG', quality=95)
+    os.replace(temp, output)
+
+  logging.info(f'Image normalized{target}: {file}')
+  image_cache().put(key, output)
+  return output
+
+
+def normalize_all(files, canvas, cwd, workers=None) -> list[str]:
+  """
+  Normalize images concurrently, results are in the same order as `files`.
+  """
+  if len(files) == 0:
+    return []
+
+  # Pillow releases the GIL when decoding and resizing
+  workers = max(1, min(workers or os.cpu_count() or 1, len(files)))
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(
+      lambda file: normalize(file, canvas, cwd), files,
+    ))
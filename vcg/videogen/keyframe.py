@@ -3,19 +3,100 @@
 import random
 
 
+# Keyframe animations are defined by a crop rectangle of the source frame,
+# described by the expressions of zoom `z`, top-left corner `x` and `y`, with
+# the following placeholders:
+#   {w}, {h}: width and height of the source frame
+#   {z}: zoom factor, the rectangle is ({w}/{z}, {h}/{z})
+#   {t}: timestamp of the output frame in seconds
+#
+# Two engines are available to render the animation:
+#   zoompan: upscale the source then crop with `zoompan`, the upscaling
+#            (`scale` times) is required to avoid jitter since zoompan rounds
+#            the rectangle to integer pixels
+#            https://trac.ffmpeg.org/ticket/4298
+#   crop: map the sub-pixel rectangle to the output directly with
+#         `perspective`, at the source resolution and without upscaling,
+#         no faster than zoompan with `scale` of 2 or 3 and slightly less
+#         sharp, see scripts/benchmark_kfa.py
+engines = ['zoompan', 'crop']
+
+
 class KeyFrame:
   """
   base class for keyframe animation.
   """
 
-  def __init__(self, fc, fps, zoom, duration):
+  def __init__(self, fc, fps, zoom, duration, scale=5, engine='zoompan'):
+    if engine not in engines:
+      raise ValueError(f'Invalid keyframe animation engine: {engine}')
     self._fc = fc
     self._fps = fps
     self._zoom = zoom
     self._duration = duration
+    self._scale = scale
+    self._engine = engine
+
+  def rect(self, duration) -> tuple[str, str, str]:
+    """
+    Expressions of the crop rectangle: zoom, x and y.
+    """
+    return '1', '0', '0'
 
   def __call__(self, input, size, duration=None):
-    pass
+    d = duration or self._duration
+    if self._engine == 'crop':
+      return self._crop(input, size, d)
+    return self._zoompan(input, size, d)
+
+  def _zoompan(self, input, size, duration):
+    w, h = size
+    z, x, y = self.rect(duration)
+    variables = {'w': 'iw', 'h': 'ih', 'z': 'zoom', 't': 'ot'}
+    return input.filter(
+      # HACK scale to 5 times (by default) of the original size to avoid
+      #  shaky zooming https://trac.ffmpeg.org/ticket/4298
+      'scale',
+      w=w * self._scale,
+      h=-2,
+    ).filter(
+      'zoompan',
+      fps=self._fps,
+      d=self._fc,
+      s=f'{w}x{h}',
+      z=z.format(**variables),
+      x=x.format(**variables),
+      y=y.format(**variables),
+    )
+
+  def _crop(self, input, size, duration):
+    z, x, y = self.rect(duration)
+    # `in` is the input frame count, starting from 1
+    t = f'(in-1)/{self._fps}'
+    z = f'({z.format(t=t)})'
+    variables = {'w': 'W', 'h': 'H', 'z': z, 't': t}
+    x0 = f'({x.format(**variables)})'
+    y0 = f'({y.format(**variables)})'
+    x1 = f'{x0}+W/{z}'
+    y1 = f'{y0}+H/{z}'
+    return input.filter(
+      'fps',
+      fps=self._fps,
+    ).filter(
+      # map the corners of the rectangle to the corners of the output
+      'perspective',
+      x0=x0, y0=y0,
+      x1=x1, y1=y0,
+      x2=x0, y2=y1,
+      x3=x1, y3=y1,
+      sense='source',
+      interpolation='linear',
+      eval='frame',
+    )
+
+  @property
+  def engine(self):
+    return self._engine
 
   @property
   def name(self):
@@ -27,34 +108,21 @@ class PanH(KeyFrame):
   Pan horizontally effect (left/right)
   """
 
-  left_to_right = 'min((iw-iw/zoom)/({duration}*2)*ot,(iw-iw/zoom)/2)'
-  right_to_left = 'max((iw-iw/zoom)*(0.5-ot/({duration}*2)),0)'
+  left_to_right = 'min(({w}-{w}/{z})/({duration}*2)*{t},({w}-{w}/{z})/2)'
+  right_to_left = 'max(({w}-{w}/{z})*(0.5-{t}/({duration}*2)),0)'
 
   def __init__(self, start_from='left',
-               fc=1, fps=25, zoom=1.3, duration=2.0):
-    super().__init__(fc, fps, zoom, duration)
+               fc=1, fps=25, zoom=1.3, duration=2.0, scale=5,
+               engine='zoompan'):
+    super().__init__(fc, fps, zoom, duration, scale, engine)
     self._start_from = start_from
     self._x = self.left_to_right if start_from == 'left' else self.right_to_left
-    self._y = '(ih-ih/zoom)/2'
+    self._y = '({h}-{h}/{z})/2'
 
-  def __call__(self, input, size, duration=None):
-    w, h = size
-    d = duration or self._duration
-    return input.filter(
-      # HACK scale to 5 times of the original size to avoid shaky zooming
-      #  https://trac.ffmpeg.org/ticket/4298
-      'scale',
-      w=w * 5,
-      h=-2,
-    ).filter(
-      'zoompan',
-      fps=self._fps,
-      d=self._fc,
-      s=f'{w}x{h}',
-      z=self._zoom,
-      x=self._x.format(duration=d),
-      y=self._y,
-    )
+  def rect(self, duration):
+    # keep placeholders other than {duration} for the engines
+    x = self._x.replace('{duration}', str(duration))
+    return str(self._zoom), x, self._y
 
   @property
   def name(self):
@@ -66,56 +134,61 @@ class Zoom(KeyFrame):
   Zoom in/out effect
   """
 
-  _zoom_in = 'min(1+{speed}*ot, {zoom})'
-  _zoom_out = 'max({zoom}-{speed}*ot, 1)'
+  _zoom_in = 'min(1+{speed}*{t}, {zoom})'
+  _zoom_out = 'max({zoom}-{speed}*{t}, 1)'
 
   def __init__(self, effect='in',
-               fc=1, fps=25, zoom=1.1, duration=1.0):
-    super().__init__(fc, fps, zoom, duration)
+               fc=1, fps=25, zoom=1.1, duration=1.0, scale=5,
+               engine='zoompan'):
+    super().__init__(fc, fps, zoom, duration, scale, engine)
     self._effect = effect
     self._z = self._zoom_in if effect == 'in' else self._zoom_out
 
-  def __call__(self, input, size, duration=None):
-    w, h = size
-    d = duration or self._duration
-    speed = round((self._zoom - 1.0) / d, 3)
-    return input.filter(
-      # HACK scale to 5 times of the original size to avoid shaky zooming
-      #  https://trac.ffmpeg.org/ticket/4298
-      'scale',
-      w=w * 5,
-      h=-2,
-    ).filter(
-      'zoompan',
-      fps=self._fps,
-      d=self._fc,
-      s=f'{w}x{h}',
-      z=self._z.format(speed=speed, zoom=self._zoom),
-      x='(iw-iw/zoom)/2',
-      y='(ih-ih/zoom)/2'
+  def rect(self, duration):
+    speed = round((self._zoom - 1.0) / duration, 3)
+    z = self._z.replace(
+      '{speed}', str(speed),
+    ).replace(
+      '{zoom}', str(self._zoom),
     )
+    return z, '({w}-{w}/{z})/2', '({h}-{h}/{z})/2'
 
   @property
   def name(self):
     return f'zoom_{self._effect}'
 
 
-def kfa(input, size: tuple[int, int], duration=None, name=None):
+def kfa(input, size: tuple[int, int], duration=None, name=None,
+        fps=25, scale=5, engine=None, seed=None):
   """
   Add keyframe animation to video.
+  `engine` is either an engine name for all effects, or a dict that maps
+  effect names to engines, e.g. {'pan_left': 'crop'}, default to zoompan.
+  The effect is picked randomly unless `name` is given, pass the same
+  `seed` to pick the same effect again.
   """
-  panleft = PanH(zoom=1.3, start_from='left')
-  panright = PanH(zoom=1.3, start_from='right')
-  zoomin = Zoom(zoom=1.5, effect='in')
-  zoomout = Zoom(zoom=1.5, effect='out')
+
+  def select(effect):
+    if isinstance(engine, dict):
+      return engine.get(effect, 'zoompan')
+    return engine or 'zoompan'
+
+  panleft = PanH(zoom=1.3, start_from='left', fps=fps, scale=scale,
+                 engine=select('pan_left'))
+  panright = PanH(zoom=1.3, start_from='right', fps=fps, scale=scale,
+                  engine=select('pan_right'))
+  zoomin = Zoom(zoom=1.5, effect='in', fps=fps, scale=scale,
+                engine=select('zoom_in'))
+  zoomout = Zoom(zoom=1.5, effect='out', fps=fps, scale=scale,
+                 engine=select('zoom_out'))
 
   ratio = size[0] / size[1]
   candidates = [panleft, panright, panleft, panright,  # more chances for pan
                 zoomin, zoomout] if ratio > 1.3 else [zoomin, zoomout]
 
   effect = (
-    random.choice(candidates) if name is None else
-    next(effect for effect in candidates if effect.name == name)
+    random.Random(seed).choice(candidates) if name is None else
+    next((effect for effect in candidates if effect.name == name), None)
   )
   if effect is None:
     raise ValueError(f'Invalid keyframe animation name: {name}')
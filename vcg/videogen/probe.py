@@ -0,0 +1,142 @@
+# Path: videogen/probe.py
+
+import ffmpeg
+import logging
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+
+
+def wav_duration(file) -> float | None:
+  """
+  Get the duration of a PCM WAV file in seconds from its RIFF header.
+  Return None if the header can not be parsed.
+  """
+  file_size = os.path.getsize(file)
+  with open(file, 'rb') as fp:
+    riff = fp.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+      return None
+
+    byte_rate = None
+    while True:
+      header = fp.read(8)
+      if len(header) < 8:
+        return None
+      chunk_id, chunk_size = struct.unpack('<4sI', header)
+      if chunk_id == b'fmt ':
+        fmt = fp.read(chunk_size)
+        if len(fmt) < 16:
+          return None
+        # audio_format, channels, sample_rate, byte_rate
+        _, _, _, byte_rate = struct.unpack('<HHII', fmt[:12])
+        # chunks are word aligned
+        fp.seek(chunk_size % 2, os.SEEK_CUR)
+      elif chunk_id == b'data':
+        if not byte_rate:
+          return None
+        # HACK! streaming TTS engines may write a bogus data size, trust the
+        #  file size in that case as ffprobe does
+        data_size = min(chunk_size, file_size - fp.tell())
+        return data_size / byte_rate
+      else:
+        fp.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+class Probe:
+  """
+  A cache of ffprobe results keyed by (path, size, mtime), the least
+  recently used results are dropped when there are more than
+  `max_entries`(VCG_PROBE_CACHE_SIZE, default to 4096).
+  """
+
+  def __init__(self, max_entries=None):
+    self._max_entries = max_entries or int(os.getenv(
+      'VCG_PROBE_CACHE_SIZE',
+      default=4096,
+    ))
+    self._cache = OrderedDict()
+    self._lock = threading.Lock()
+    self._hits = 0
+    self._misses = 0
+
+  def _key(self, file):
+    stat = os.stat(file)
+    return os.path.abspath(file), stat.st_size, stat.st_mtime_ns
+
+  def _lookup(self, key, fetch):
+    with self._lock:
+      if key in self._cache:
+        self._hits += 1
+        self._cache.move_to_end(key)
+        return self._cache[key]
+      self._misses += 1
+
+    value = fetch()
+    with self._lock:
+      self._cache[key] = value
+      while len(self._cache) > self._max_entries:
+        self._cache.popitem(last=False)
+    return value
+
+  def __len__(self):
+    return len(self._cache)
+
+  def probe(self, file) -> dict:
+    """
+    ffprobe the file, or return the cached result.
+    """
+    key = self._key(file)
+    return self._lookup(key, lambda: ffmpeg.probe(file))
+
+  def duration(self, file) -> float:
+    """
+    Get the duration of a video/audio file in seconds.
+    WAV durations are read from the RIFF header without ffprobe.
+    """
+    key = self._key(file)
+    if str(file).lower().endswith('.wav'):
+      d = self._lookup((*key, 'wav'), lambda: wav_duration(file))
+      if d is not None:
+        return d
+      logging.warning(f'Failed to parse WAV header: {file}')
+
+    probe = self._lookup(key, lambda: ffmpeg.probe(file))
+    return max([float(s['duration']) for s in probe['streams']
+                if s.get('duration') is not None])
+
+  def size(self, file) -> tuple[int, int]:
+    """
+    Get the resolution of a video file in pixels
+    """
+    probe = self.probe(file)
+    vstream = next((s for s in probe['streams']
+                   if s['codec_type'] == 'video'), None)
+    if vstream is None:
+      raise RuntimeError(f'ffprobe: No video stream found in {file}')
+
+    return int(vstream['width']), int(vstream['height'])
+
+  @property
+  def hits(self):
+    return self._hits
+
+  @property
+  def misses(self):
+    return self._misses
+
+  def clear(self):
+    with self._lock:
+      self._cache.clear()
+      self._hits = 0
+      self._misses = 0
+
+  _singleton = None
+
+  @classmethod
+  def instance(cls):
+    if Probe._singleton is None:
+      Probe._singleton = Probe()
+    return Probe._singleton
@@ -0,0 +1,105 @@
+# Path: videogen/profile.py
+
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Profile:
+  """
+  Render quality profile of the videogen pipeline.
+  """
+  name: str
+  # x264 preset, https://trac.ffmpeg.org/wiki/Encode/H.264#Preset
+  preset: str
+  crf: int
+  fps: int
+  # output resolution (width, height) if not specified by the request
+  size: tuple[int, int]
+  # upscale factor before zoompan to avoid shaky keyframe animation
+  kfa_scale: int
+  # keyframe animation engine, or a dict of {effect name: engine}
+  kfa_engine: str | dict[str, str] = 'zoompan'
+
+
+profiles = {
+  # fast iteration for editors, lower fps and smaller canvas
+  'draft': Profile(
+    name='draft',
+    preset='ultrafast',
+    crf=28,
+    fps=15,
+    size=(360, 640),
+    kfa_scale=2,
+  ),
+  'standard': Profile(
+    name='standard',
+    preset='veryfast',
+    crf=23,
+    fps=25,
+    size=(720, 1280),
+    kfa_scale=3,
+  ),
+  # same quality as before profiles were introduced
+  'archive': Profile(
+    name='archive',
+    preset='medium',
+    crf=20,
+    fps=25,
+    size=(720, 1280),
+    kfa_scale=5,
+  ),
+}
+
+default_profile = 'archive'
+
+
+def get_profile(name: str | None = None) -> Profile:
+  """
+  Get render profile by name, use the default profile if name is None.
+  """
+  name = name or default_profile
+  if name not in profiles:
+    raise ValueError(f'Invalid render profile: {name}')
+  return profiles[name]
+
+
+@dataclass(frozen=True)
+class Rendition:
+  """
+  An extra variant of the final video, e.g. a lower bitrate one.
+  """
+  # output resolution (width, height)
+  size: tuple[int, int]
+  # quality of the render profile if neither crf nor bitrate is given,
+  # bitrate(e.g. '1M') overrides crf
+  crf: int | None = None
+  bitrate: str | None = None
+  # fps of the render profile if not given
+  fps: int | None = None
+
+  @property
+  def name(self) -> str:
+    width, height = self.size
+    name = f'{width}x{height}'
+    if self.bitrate is not None:
+      return f'{name}_{self.bitrate}'
+    if self.crf is not None:
+      return f'{name}_crf{self.crf}'
+    return name
+
+
+def get_rendition(rendition: Rendition | dict) -> Rendition:
+  """
+  Get rendition from workflow parameters,
+  e.g. {'size': [360, 640], 'bitrate': '800k', 'fps': 15}.
+  """
+  if isinstance(rendition, Rendition):
+    return rendition
+  if 'size' not in rendition:
+    raise ValueError(f'Rendition without size: {rendition}')
+  return Rendition(
+    size=tuple(rendition['size']),
+    crf=rendition.get('crf'),
+    bitrate=rendition.get('bitrate'),
+    fps=rendition.get('fps'),
+  )
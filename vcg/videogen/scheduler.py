@@ -0,0 +1,162 @@
+# Path: videogen/scheduler.py
+
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+from contextlib import asynccontextmanager, contextmanager
+
+
+def cpu_cores() -> int:
+  """
+  Number of CPU cores available to this process.
+  """
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+class Scheduler:
+  """
+  A host-level semaphore of ffmpeg jobs shared by all worker processes.
+  Each slot is a lock file in `root`, a job holds one slot (flock) while
+  ffmpeg is running, so at most `slots` jobs run at the same time on the
+  host. The lock is released by the kernel if the process dies.
+
+  Every job gets a fixed thread budget of the available cores divided by
+  the number of slots, so the budgets of all running jobs never add up to
+  more than the cores, instead of libx264's default of one thread per core
+  in every process.
+  """
+
+  def __init__(self, slots=None, root=None, cores=None, poll=0.1):
+    self._cores = cores or int(os.getenv('VCG_FFMPEG_CORES', cpu_cores()))
+    self._slots = slots or int(os.getenv(
+      'VCG_FFMPEG_SLOTS',
+      default=max(1, self._cores // 2),
+    ))
+    self._root = root or os.getenv(
+      'VCG_FFMPEG_LOCK_DIR',
+      default=os.path.join(tempfile.gettempdir(), 'vcg-ffmpeg'),
+    )
+    self._poll = poll
+    os.makedirs(self._root, exist_ok=True)
+
+  def _path(self, i):
+    return os.path.join(self._root, f'slot-{i}.lock')
+
+  def _try_lock(self, i):
+    fd = os.open(self._path(i), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      os.close(fd)
+      return None
+    return fd
+
+  def _unlock(self, fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+  def busy(self) -> int:
+    """
+    Number of slots held by running jobs on the host.
+    """
+    count = 0
+    for i in range(self._slots):
+      fd = self._try_lock(i)
+      if fd is None:
+        count += 1
+      else:
+        self._unlock(fd)
+    return count
+
+  def threads(self) -> int:
+    """
+    Thread budget of a job, the same for every slot.
+    """
+    return max(1, self._cores // self._slots)
+
+  def _acquire(self):
+    """
+    Lock a free slot, return its file descriptor or None if all are busy.
+    """
+    for i in range(self._slots):
+      fd = self._try_lock(i)
+      if fd is not None:
+        return fd
+    return None
+
+  def _waiting(self, timeout=None, on_wait=None, interval=5.0):
+    """
+    Generator of the waiting loop, yield after each failed attempt.
+    """
+    start = time.monotonic()
+    notified = start
+    while True:
+      now = time.monotonic()
+      if timeout is not None and now - start >= timeout:
+        raise TimeoutError(
+          f'No ffmpeg slot available in {timeout}s: {self._root}')
+      if on_wait is not None and now - notified >= interval:
+        notified = now
+        on_wait(now - start)
+      yield now - start
+
+  @contextmanager
+  def slot(self, timeout=None, on_wait=None, interval=5.0):
+    """
+    Hold a slot while in the context, yield the thread budget of the job.
+    Block until a slot is available, raise TimeoutError after `timeout`
+    seconds. `on_wait` is called with the waiting time every `interval`
+    seconds, e.g. to heartbeat while queued.
+    """
+    waited = 0.0
+    waiting = self._waiting(timeout, on_wait, interval)
+    while (fd := self._acquire()) is None:
+      waited = next(waiting)
+      time.sleep(self._poll)
+
+    if waited >= interval:
+      logging.info(f'Waited {waited:.1f}s for a ffmpeg slot')
+    try:
+      yield self.threads()
+    finally:
+      self._unlock(fd)
+
+  @asynccontextmanager
+  async def aslot(self, timeout=None, on_wait=None, interval=5.0):
+    """
+    Async version of slot(), wait without blocking the event loop.
+    """
+    waited = 0.0
+    waiting = self._waiting(timeout, on_wait, interval)
+    while (fd := self._acquire()) is None:
+      waited = next(waiting)
+      await asyncio.sleep(self._poll)
+
+    if waited >= interval:
+      logging.info(f'Waited {waited:.1f}s for a ffmpeg slot')
+    try:
+      yield self.threads()
+    finally:
+      self._unlock(fd)
+
+  @property
+  def slots(self):
+    return self._slots
+
+  @property
+  def cores(self):
+    return self._cores
+
+  _singleton = None
+
+  @classmethod
+  def instance(cls):
+    if Scheduler._singleton is None:
+      Scheduler._singleton = Scheduler()
+    return Scheduler._singleton
@@ -0,0 +1,91 @@
+# Path: videogen/subtitles.py
+
+import pysubs2
+
+from pysubs2 import SSAFile
+
+
+# libass assumes this resolution if PlayResX/PlayResY are missing
+default_play_res = (384, 288)
+
+
+def play_res(subs: SSAFile) -> tuple[int, int]:
+  """
+  Get the script resolution (PlayResX, PlayResY) of the subtitle.
+  """
+  return (
+    int(subs.info.get('PlayResX', default_play_res[0])),
+    int(subs.info.get('PlayResY', default_play_res[1])),
+  )
+
+
+def rescale(subs: SSAFile, size: tuple[int, int]) -> SSAFile:
+  """
+  Rescale the subtitle (in place) to the video size, so libass renders it
+  without scaling. Font sizes keep the aspect ratio and fit the width.
+  Override tags in the text, e.g. \\pos, are not rescaled.
+  """
+  width, height = size
+  res_x, res_y = play_res(subs)
+  if (res_x, res_y) == (width, height):
+    return subs
+
+  sx, sy = width / res_x, height / res_y
+  scale = min(sx, sy)
+  for style in subs.styles.values():
+    style.fontsize = round(style.fontsize * scale, 2)
+    style.outline = round(style.outline * scale, 2)
+    style.shadow = round(style.shadow * scale, 2)
+    style.marginl = round(style.marginl * sx)
+    style.marginr = round(style.marginr * sx)
+    style.marginv = round(style.marginv * sy)
+  for event in subs.events:
+    event.marginl = round(event.marginl * sx)
+    event.marginr = round(event.marginr * sx)
+    event.marginv = round(event.marginv * sy)
+
+  subs.info.update({
+    'PlayResX': width,
+    'PlayResY': height,
+  })
+  return subs
+
+
+def merge(files, durations, size: tuple[int, int]) -> SSAFile:
+  """
+  Merge the subtitles of clips into a single timeline of the concatenated
+  video, events of each clip are offset by the total duration(seconds) of
+  the clips before it, styles are rescaled to the video size.
+  """
+  if len(files) != len(durations):
+    raise ValueError('The number of subtitles and durations must be the same')
+
+  width, height = size
+  merged = SSAFile()
+  merged.info.update({
+    'PlayResX': width,
+    'PlayResY': height,
+  })
+  merged.styles = {}
+
+  offset = 0.0
+  for i, (file, d) in enumerate(zip(files, durations)):
+    subs = rescale(pysubs2.load(str(file)), size)
+
+    # styles of the same name may differ from clip to clip
+    names = {}
+    for name, style in subs.styles.items():
+      if name in merged.styles and merged.styles[name] != style:
+        names[name] = f'{name}_{i}'
+      else:
+        names[name] = name
+      merged.styles[names[name]] = style
+
+    for event in subs.events:
+      event.shift(ms=round(offset * 1000))
+      event.style = names.get(event.style, event.style)
+      merged.events.append(event)
+
+    offset += d
+
+  return merged